@@ -1,44 +1,163 @@
 import nibabel as nib
 import numpy as np
 import os
+import shutil
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+from volume_io import open_image
+from label_store import open_label_store
+from instrumentation import RunReport, CaseTimer
+
+# Number of z slices converted at a time; only one slab is ever held as float
+slab_size = 16
+# Number of files converted in parallel
+max_workers = os.cpu_count()
+# Optional directory of chunked label stores (see label_store.py) used to read integer label maps; None reads the files
+label_store_dir = None
+# Per-file stage timings as JSON lines and/or a Prometheus text file (see instrumentation.py); None disables them
+report_jsonl = None
+report_prometheus = None
+
+INT16_MIN = np.iinfo(np.int16).min
+INT16_MAX = np.iinfo(np.int16).max
+
+# Convert one slab to int16: values are truncated toward zero as astype does, but values outside the int16 range
+# are clipped instead of wrapping around and NaNs become 0. Returns the slab and the (below, above, nan) counts.
+def slab_to_int16(slab):
+    if np.issubdtype(slab.dtype, np.integer) and np.can_cast(slab.dtype, np.int16):
+        return slab.astype(np.int16), 0, 0, 0
+    n_nan = 0
+    if np.issubdtype(slab.dtype, np.floating):
+        nan_mask = np.isnan(slab)
+        n_nan = int(nan_mask.sum())
+        slab = np.trunc(slab)
+        if n_nan:
+            slab[nan_mask] = 0
+    n_below = int(np.count_nonzero(slab < INT16_MIN))
+    n_above = int(np.count_nonzero(slab > INT16_MAX))
+    if n_below or n_above:
+        slab = np.clip(slab, INT16_MIN, INT16_MAX)
+    return slab.astype(np.int16), n_below, n_above, n_nan
+
+# The label store for an integer-valued image, or None when no store directory is configured or the data is not integral
+def label_store_for(image_path, label_store_dir):
+    if label_store_dir is None:
+        return None
+    try:
+        return open_label_store(image_path, label_store_dir)
+    except ValueError:
+        return None
+
+# Function to convert image data type to 16-bit integer.
+# instrument=True adds the per-stage timing record for the run report under report['timing'].
+def convert_to_int16(image_path, output_path, slab_size=slab_size, label_store_dir=label_store_dir, instrument=False):
+    report = {'file': os.path.basename(image_path), 'status': 'converted', 'clipped_below': 0, 'clipped_above': 0, 'nan': 0}
+    timer = CaseTimer(report['file'], enabled=instrument)
+    timer.read_file(image_path)
+
+    # The file is closed again before the output (possibly the same file) is written
+    with open_image(image_path) as img:
+        header = img.header
+
+        # Files already stored as unscaled int16 need no conversion. nibabel moves scl_slope/scl_inter from the
+        # header onto the data proxy when loading, so the scaling is read from there
+        slope, inter = img.dataobj.slope, img.dataobj.inter
+        if header.get_data_dtype() == np.int16 and slope == 1 and inter == 0:
+            report['status'] = 'already int16'
+        elif (store := label_store_for(image_path, label_store_dir)) is not None:
+            # Integer label maps come straight from the label store, already in a small integer dtype
+            with timer.stage('read'):
+                data = store.read_region()
+            with timer.stage('convert'):
+                img_data_int16, report['clipped_below'], report['clipped_above'], report['nan'] = slab_to_int16(data)
+        else:
+            # Convert slab by slab along z so the float copy stays small
+            if len(img.shape) < 3:
+                slabs = [Ellipsis]
+            else:
+                slabs = [np.s_[:, :, z:z + slab_size] for z in range(0, img.shape[2], slab_size)]
+            img_data_int16 = np.empty(img.shape, dtype=np.int16)
+            for slab in slabs:
+                with timer.stage('read'):
+                    data = np.asanyarray(img.dataobj[slab])
+                with timer.stage('convert'):
+                    img_data_int16[slab], n_below, n_above, n_nan = slab_to_int16(data)
+                report['clipped_below'] += n_below
+                report['clipped_above'] += n_above
+                report['nan'] += n_nan
+
+    if report['status'] == 'already int16':
+        if os.path.abspath(image_path) != os.path.abspath(output_path):
+            with timer.stage('write'):
+                shutil.copyfile(image_path, output_path)
+            timer.wrote_file(output_path)
+            print(f"Already int16, copied image to {output_path}")
+        else:
+            print(f"Already int16, left {output_path} unchanged")
+        if instrument:
+            report['timing'] = timer.finish(report['status'])
+        return report
 
-# Function to convert image data type to 16-bit integer
-def convert_to_int16(image_path, output_path):
-    # Load the image
-    img = nib.load(image_path)
-    
-    # Get the image data
-    img_data = img.get_fdata()
-    
-    # Convert the data to 16-bit integer (int16)
-    img_data_int16 = img_data.astype(np.int16)
-    
     # Save the modified image with int16 data
-    modified_img = nib.Nifti1Image(img_data_int16, img.affine, img.header)
+    modified_img = nib.Nifti1Image(img_data_int16, header.get_best_affine(), header)
     # Update the data type in the header to reflect the new data type
     modified_img.header.set_data_dtype(np.int16)
-    
-    # Save the new image
-    nib.save(modified_img, output_path)
-    print(f"Converted to int16 and saved image to {output_path}")
+
+    # Save to a temporary file next to the output and rename it over the output, so converting in place
+    # never leaves a half-written file behind. The temporary name keeps the extension nibabel uses to pick compression.
+    output_dir, output_name = os.path.split(output_path)
+    tmp_path = os.path.join(output_dir, f".tmp{os.getpid()}_{output_name}")
+    try:
+        with timer.stage('write'):
+            nib.save(modified_img, tmp_path)
+            os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    timer.wrote_file(output_path)
+
+    n_clipped = report['clipped_below'] + report['clipped_above']
+    if n_clipped or report['nan']:
+        print(f"Converted to int16 and saved image to {output_path} "
+              f"({report['clipped_below']} voxels clipped below, {report['clipped_above']} clipped above, {report['nan']} NaN set to 0)")
+    else:
+        print(f"Converted to int16 and saved image to {output_path}")
+    if instrument:
+        timer.set(clipped=n_clipped, nan=report['nan'])
+        report['timing'] = timer.finish(report['status'])
+    return report
 
 # Main function to process all files in a directory
-def process_directory(input_directory, output_directory):
+def process_directory(input_directory, output_directory, max_workers=max_workers, label_store_dir=label_store_dir,
+                      report_jsonl=report_jsonl, report_prometheus=report_prometheus):
     # Check if output directory exists, if not, create it
     if not os.path.exists(output_directory):
         os.makedirs(output_directory)
 
-    # Loop through all .nii and .nii.gz files in the input directory
-    for filename in os.listdir(input_directory):
-        if filename.endswith('.nii') or filename.endswith('.nii.gz'):
-            image_path = os.path.join(input_directory, filename)
-            output_path = os.path.join(output_directory, filename)
-            print(f"Processing {filename}...")
-            convert_to_int16(image_path, output_path)
+    # Collect all .nii and .nii.gz files in the input directory
+    filenames = sorted(
+        filename for filename in os.listdir(input_directory)
+        if filename.endswith('.nii') or filename.endswith('.nii.gz')
+    )
+    image_paths = [os.path.join(input_directory, filename) for filename in filenames]
+    output_paths = [os.path.join(output_directory, filename) for filename in filenames]
+
+    # Convert the files in parallel, one file per task
+    with RunReport('ConvertTo16Bit', report_jsonl, report_prometheus) as run_report:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            reports = list(executor.map(convert_to_int16, image_paths, output_paths, repeat(slab_size), repeat(label_store_dir), repeat(run_report.enabled)))
+        for report in reports:
+            run_report.record(report.pop('timing', None))
+
+    n_clipped = sum(1 for report in reports if report['clipped_below'] or report['clipped_above'] or report['nan'])
+    n_skipped = sum(1 for report in reports if report['status'] == 'already int16')
+    print(f"Processed {len(reports)} files: {n_skipped} already int16, {n_clipped} with clipped or NaN voxels")
+    return reports
 
 # Specify input and output directories
 input_directory = 'F:/Registration Code/CroppedNCCTAnatomy/labels/final/final_Labels/New folder'  # Replace with your input directory path
 output_directory = 'F:/Registration Code/CroppedNCCTAnatomy/labels/final/final_Labels/New folder'  # Replace with your output directory path
 
-# Call the process directory function to convert all images to int16
-process_directory(input_directory, output_directory)
+if __name__ == "__main__":
+    # Call the process directory function to convert all images to int16
+    process_directory(input_directory, output_directory)
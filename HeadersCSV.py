@@ -1,6 +1,16 @@
 import os
-import nibabel as nib
 import csv
+import gzip
+import nibabel as nib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from instrumentation import RunReport, NULL_TIMER
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pa = None
 
 # Define the directory containing the NIFTI files
 nifti_dir = "F:/Registration Code/CTA_Kevin_Training_16Septv2andNormsComplete/NEW/CroppedNCCTAnatomy/CroppedNCCTAnatomy/output/labels/final"
@@ -8,6 +18,20 @@ nifti_dir = "F:/Registration Code/CTA_Kevin_Training_16Septv2andNormsComplete/NE
 # Define the path for the output CSV file
 output_csv = os.path.join(nifti_dir, "nifti_headers_with_original_pixdim.csv")
 
+# Optional columnar output with dim/pixdim split into numeric columns (None to skip).
+# .parquet and .arrow need pyarrow; without it the table is written as CSV next to the requested path.
+columnar_output = os.path.join(nifti_dir, "nifti_headers.parquet")
+
+# Number of files read concurrently (header reads are I/O bound)
+max_workers = 16
+
+# Rows buffered before each columnar write
+batch_size = 1024
+
+# Per-file timings as JSON lines and/or a Prometheus text file (see instrumentation.py); None disables them
+report_jsonl = None
+report_prometheus = None
+
 # List of header fields to extract from NIFTI files
 header_fields = [
     "sizeof_hdr", "dim_info", "dim", "intent_p1", "intent_p2", "intent_p3", "intent_code",
@@ -16,35 +40,168 @@ header_fields = [
     "toffset", "glmax", "glmin"
 ]
 
-# Open the CSV file for writing
-with open(output_csv, mode='w', newline='') as csvfile:
-    writer = csv.writer(csvfile)
-
-    # Write the header row (filename + header fields + original pixdim)
-    writer.writerow(["Filename"] + header_fields + ["Original_pixdim"])
-
-    # Loop through all files in the directory
-    for filename in os.listdir(nifti_dir):
-        # Check if the file is a NIFTI file (.nii or .nii.gz)
-        if filename.endswith('.nii') or filename.endswith('.nii.gz'):
-            # Construct the full path to the file
-            file_path = os.path.join(nifti_dir, filename)
-            
-            # Load the NIFTI file
-            try:
-                nii = nib.load(file_path)
-                header = nii.header
-                
-                # Extract header values based on the specified fields
-                header_values = [header.get(field, "N/A") for field in header_fields]
+# Size of the NIfTI-1 and NIfTI-2 headers in bytes (also the value of their sizeof_hdr field)
+NIFTI1_HEADER_SIZE = 348
+NIFTI2_HEADER_SIZE = 540
+
+# sizeof_hdr of a header block, in whichever byte order makes it a known header size
+def header_size(binaryblock):
+    for byteorder in ('little', 'big'):
+        size = int.from_bytes(binaryblock[:4], byteorder)
+        if size in (NIFTI1_HEADER_SIZE, NIFTI2_HEADER_SIZE):
+            return size
+    return None
 
-                # Extract the original pixdim values before any modifications
-                original_pixdim = header['pixdim']
+# Read only the header bytes of a NIFTI file; for .nii.gz only the first gzip block(s) are decompressed.
+# Values are reported as stored in the file (nib.load resets vox_offset/scl_slope/scl_inter in its in-memory copy).
+def read_nifti_header(file_path, timer=NULL_TIMER):
+    opener = gzip.open if file_path.endswith('.gz') else open
+    with timer.stage('read_header'), opener(file_path, 'rb') as f:
+        binaryblock = f.read(NIFTI1_HEADER_SIZE)
+        size = header_size(binaryblock)
+        if size == NIFTI2_HEADER_SIZE:
+            binaryblock += f.read(NIFTI2_HEADER_SIZE - len(binaryblock))
+    timer.add_bytes(read=len(binaryblock))
+    try:
+        if size == NIFTI1_HEADER_SIZE:
+            return nib.Nifti1Header(binaryblock)
+        if size == NIFTI2_HEADER_SIZE:
+            return nib.Nifti2Header(binaryblock)
+    except Exception:
+        pass
+    # Not a readable NIfTI-1/NIfTI-2 header block: let nibabel work it out
+    return nib.load(file_path).header
 
-                # Write the filename, header values, and original pixdim to the CSV
-                writer.writerow([filename] + header_values + [original_pixdim.tolist()])
+# Read headers on a thread pool and yield (filename, header, error) as each file finishes.
+# With a RunReport, each file's timing record is added to it as the file is yielded.
+def scan_headers(nifti_dir, filenames, max_workers=max_workers, report=None):
+    report = report or RunReport('HeadersCSV')
+    timers = {filename: report.case(filename) for filename in filenames}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(read_nifti_header, os.path.join(nifti_dir, filename), timers[filename]): filename for filename in filenames}
+        for future in as_completed(futures):
+            filename = futures[future]
+            try:
+                header = future.result()
             except Exception as e:
-                # In case of error, write the filename and the error message
-                writer.writerow([filename] + [f"Error: {e}"] * len(header_fields) + ["Error"])
+                report.record(timers[filename].finish('error'))
+                yield filename, None, e
+            else:
+                report.record(timers[filename].finish())
+                yield filename, header, None
+
+# Typed columns for the columnar output: array fields such as dim and pixdim get one column per element
+def columnar_schema():
+    columns = [("Filename", "string")]
+    for field in header_fields:
+        dtype = nib.Nifti1Header.template_dtype[field]
+        kind = "float" if dtype.base.kind == "f" else "int"
+        if dtype.shape:
+            columns += [(f"{field}_{i}", kind) for i in range(dtype.shape[0])]
+        else:
+            columns.append((field, kind))
+    columns.append(("Error", "string"))
+    return columns
+
+# Fields the header does not have (glmax/glmin in NIfTI-2 headers) are left null
+def columnar_record(filename, header=None, error=None):
+    record = {"Filename": filename, "Error": None if error is None else str(error)}
+    if header is not None:
+        for field in header_fields:
+            if field not in header:
+                continue
+            value = header[field]
+            if value.ndim:
+                record.update((f"{field}_{i}", v.item()) for i, v in enumerate(value))
+            else:
+                record[field] = value.item()
+    return record
+
+# Streams records to Parquet or Arrow IPC in batches, or to CSV when pyarrow is missing
+class ColumnarWriter:
+    def __init__(self, path, batch_size=batch_size):
+        self.columns = columnar_schema()
+        self.batch_size = batch_size
+        self._records = []
+        use_arrow = pa is not None and path.endswith((".parquet", ".arrow"))
+        if use_arrow:
+            types = {"string": pa.string(), "int": pa.int64(), "float": pa.float64()}
+            self._schema = pa.schema([(name, types[kind]) for name, kind in self.columns])
+            if path.endswith(".parquet"):
+                self._writer = pa.parquet.ParquetWriter(path, self._schema)
+            else:
+                self._writer = pa.ipc.new_file(path, self._schema)
+            self.path = path
+        else:
+            self._schema = None
+            self.path = os.path.splitext(path)[0] + ".csv" if not path.endswith(".csv") else path
+            self._file = open(self.path, mode='w', newline='')
+            self._writer = csv.DictWriter(self._file, fieldnames=[name for name, _ in self.columns])
+            self._writer.writeheader()
+
+    def write(self, record):
+        if self._schema is None:
+            self._writer.writerow(record)
+            return
+        self._records.append(record)
+        if len(self._records) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._schema is not None and self._records:
+            self._writer.write_batch(pa.RecordBatch.from_pylist(self._records, schema=self._schema))
+            self._records = []
+
+    def close(self):
+        if self._schema is None:
+            self._file.close()
+        else:
+            self.flush()
+            self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def main(nifti_dir=nifti_dir, output_csv=output_csv, columnar_output=columnar_output, report_jsonl=report_jsonl, report_prometheus=report_prometheus):
+    filenames = [filename for filename in os.listdir(nifti_dir) if filename.endswith('.nii') or filename.endswith('.nii.gz')]
+    columnar = ColumnarWriter(columnar_output) if columnar_output else None
+
+    # Open the CSV file for writing
+    with RunReport('HeadersCSV', report_jsonl, report_prometheus) as report, open(output_csv, mode='w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+
+        # Write the header row (filename + header fields + original pixdim)
+        writer.writerow(["Filename"] + header_fields + ["Original_pixdim"])
+
+        # Rows are written as soon as each file's header has been read
+        try:
+            for filename, header, error in scan_headers(nifti_dir, filenames, report=report):
+                if error is None:
+                    # Extract header values based on the specified fields
+                    header_values = [header.get(field, "N/A") for field in header_fields]
+
+                    # Extract the original pixdim values before any modifications
+                    original_pixdim = header['pixdim']
+
+                    # Write the filename, header values, and original pixdim to the CSV
+                    writer.writerow([filename] + header_values + [original_pixdim.tolist()])
+                else:
+                    # In case of error, write the filename and the error message
+                    writer.writerow([filename] + [f"Error: {error}"] * len(header_fields) + ["Error"])
+                if columnar is not None:
+                    with report.stage('write_columnar'):
+                        columnar.write(columnar_record(filename, header, error))
+        finally:
+            if columnar is not None:
+                with report.stage('write_columnar'):
+                    columnar.close()
+
+    print(f"NIFTI headers and original pixdim values have been saved to {output_csv}")
+    if columnar is not None:
+        print(f"Columnar header table has been saved to {columnar.path}")
 
-print(f"NIFTI headers and original pixdim values have been saved to {output_csv}")
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,16 @@
 import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
 import requests
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging
+from instrumentation import RunReport, NULL_TIMER
+from result_cache import file_fingerprint
 
 # Define paths and server details
 input_dir = "/Users/jamesdowney/Documents/Project_Data/Cleaned_and_Labelled/TSS/Generated Segmentations/batch/path_batch_input_path"
@@ -10,8 +18,22 @@ output_dir = "/Users/jamesdowney/Documents/Project_Data/Cleaned_and_Labelled/TSS
 server_url = "http://54.206.132.176:8003/infer/segmentation"
 model_name = "segmentation"
 
-# Ensure output directory exists
-os.makedirs(output_dir, exist_ok=True)
+# Maximum number of inference requests in flight at once (1 sends the files one at a time)
+concurrency = 4
+# Size of the blocks streamed to and from the server
+chunk_size = 1024 * 1024
+# Inference cache: an append-only manifest of finished files keyed on the input's sha256, the model name and the
+# model version. Inputs already in the manifest whose output is still on disk are not sent again.
+# None keeps the manifest in output_dir as MANIFEST_NAME.
+manifest_path = None
+MANIFEST_NAME = "inference_manifest.jsonl"
+# Model version folded into the cache key; with query_model_version the version the server reports is used instead
+model_version = None
+query_model_version = False
+
+# Per-file timings as JSON lines and/or a Prometheus text file (None to disable)
+report_jsonl = None
+report_prometheus = None
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -25,6 +47,138 @@ def strip_multipart_headers(response_content):
             return part.split(b'\r\n\r\n', 1)[1].rsplit(b'\r\n', 1)[0]
     return None
 
+# Streams a multipart/form-data upload straight from disk.
+# It is seekable and has a known length, so the request is sent with a Content-Length
+# and the Retry policy can rewind and resend the body.
+class MultipartFileBody:
+    def __init__(self, path, fields, file_field='file'):
+        boundary = uuid.uuid4().hex
+        self.content_type = f'multipart/form-data; boundary={boundary}'
+        head = b''.join(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+            for name, value in fields.items()
+        )
+        head += (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; filename="{os.path.basename(path)}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n'
+        ).encode()
+        self._head = head
+        self._tail = f'\r\n--{boundary}--\r\n'.encode()
+        self._file = open(path, 'rb')
+        self._file_size = os.fstat(self._file.fileno()).st_size
+        self._length = len(self._head) + self._file_size + len(self._tail)
+        self._position = 0
+
+    def __len__(self):
+        return self._length
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self._length
+        self._position = min(max(offset, 0), self._length)
+        return self._position
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._length - self._position
+        chunks = []
+        while size > 0 and self._position < self._length:
+            file_start = len(self._head)
+            file_end = file_start + self._file_size
+            if self._position < file_start:
+                chunk = self._head[self._position:min(file_start, self._position + size)]
+            elif self._position < file_end:
+                self._file.seek(self._position - file_start)
+                chunk = self._file.read(min(size, file_end - self._position))
+            else:
+                offset = self._position - file_end
+                chunk = self._tail[offset:offset + size]
+            if not chunk:
+                break
+            chunks.append(chunk)
+            self._position += len(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+# Incremental version of strip_multipart_headers: fed the response chunk by chunk, it writes the
+# first application/octet-stream part to output_file without holding the whole response in memory
+class MultipartPartWriter:
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self.found = False
+        self.bytes_written = 0
+        self._buffer = b''
+        self._delimiter = None
+        self._state = 'preamble'
+        self._in_target = False
+
+    def feed(self, chunk):
+        self._buffer += chunk
+        while self._state != 'done':
+            if self._state == 'preamble':
+                # As in strip_multipart_headers, the first line of the body is the boundary
+                end = self._buffer.find(b'\r\n')
+                if end < 0:
+                    return
+                self._delimiter = b'\r\n' + self._buffer[:end]
+                self._buffer = self._buffer[end + 2:]
+                self._state = 'headers'
+            elif self._state == 'headers':
+                end = self._buffer.find(b'\r\n\r\n')
+                if end < 0:
+                    return
+                headers = self._buffer[:end]
+                self._buffer = self._buffer[end + 4:]
+                self._in_target = not self.found and b'content-type: application/octet-stream' in headers.lower()
+                self._state = 'body'
+            elif self._state == 'body':
+                end = self._buffer.find(self._delimiter)
+                if end < 0:
+                    # Keep enough bytes back to recognise a delimiter split across chunks
+                    keep = len(self._delimiter) - 1
+                    if len(self._buffer) > keep:
+                        self._write(self._buffer[:len(self._buffer) - keep])
+                        self._buffer = self._buffer[len(self._buffer) - keep:]
+                    return
+                self._write(self._buffer[:end])
+                if self._in_target:
+                    self.found = True
+                    self._in_target = False
+                self._buffer = self._buffer[end + len(self._delimiter):]
+                self._state = 'boundary'
+            elif self._state == 'boundary':
+                if len(self._buffer) < 2:
+                    return
+                if self._buffer.startswith(b'--'):
+                    self._buffer = b''
+                    self._state = 'done'
+                else:
+                    # Skip the rest of the boundary line (CRLF, possibly preceded by whitespace)
+                    end = self._buffer.find(b'\r\n')
+                    if end < 0:
+                        return
+                    self._buffer = self._buffer[end + 2:]
+                    self._state = 'headers'
+
+    def _write(self, data):
+        if self._in_target and data:
+            self.output_file.write(data)
+            self.bytes_written += len(data)
+
 # Set up retry strategy
 retry_strategy = Retry(
     total=3,
@@ -32,35 +186,215 @@ retry_strategy = Retry(
     status_forcelist=[429, 500, 502, 503, 504],
     allowed_methods=["POST"]  # Updated argument name
 )
-adapter = HTTPAdapter(max_retries=retry_strategy)
-http = requests.Session()
-http.mount("http://", adapter)
-http.mount("https://", adapter)
-
-try:
-    # Iterate over images and send inference requests
-    for img_name in os.listdir(input_dir):
-        img_path = os.path.join(input_dir, img_name)
-        with open(img_path, 'rb') as file:
-            files = {'file': file}
-            data = {'model': model_name}
 
+def create_session(pool_size=concurrency):
+    # One pooled session shared by all worker threads; the pool holds a connection per in-flight request
+    adapter = HTTPAdapter(max_retries=retry_strategy, pool_connections=1, pool_maxsize=max(pool_size, 1))
+    http = requests.Session()
+    http.mount("http://", adapter)
+    http.mount("https://", adapter)
+    return http
+
+# Temporary name next to path; files are written there and renamed into place once complete
+def temporary_path(path):
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f".tmp{uuid.uuid4().hex[:8]}_{name}")
+
+def infer_file(http, img_path, output_path, url=server_url, model=model_name, timer=NULL_TIMER):
+    # Sends one image and streams the returned segmentation to output_path.
+    # Returns (latency in seconds, bytes uploaded, bytes written), or None if the response had no image part.
+    # timer gets 'request' (upload and server time, up to the response headers) and 'download' stages.
+    img_name = os.path.basename(img_path)
+    tmp_path = temporary_path(output_path)
+    start = time.perf_counter()
+    try:
+        with MultipartFileBody(img_path, {'model': model}) as body:
+            with timer.stage('request'):
+                response = http.post(url, data=body, headers={'Content-Type': body.content_type}, stream=True)
+            with response, timer.stage('download'):
+                response.raise_for_status()
+                with open(tmp_path, 'wb') as f:
+                    writer = MultipartPartWriter(f)
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        writer.feed(chunk)
+            bytes_sent = len(body)
+        timer.add_bytes(read=bytes_sent, written=writer.bytes_written)
+        # The segmentation only appears under its real name once it is complete
+        if writer.found:
+            os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    latency = time.perf_counter() - start
+
+    if not writer.found:
+        logging.error(f"Failed to strip headers for {img_name}")
+        return None
+    logging.info(f"{img_name} saved to output directory ({latency:.2f} s, {bytes_sent / 1e6:.1f} MB sent, {writer.bytes_written / 1e6:.1f} MB received)")
+    return latency, bytes_sent, writer.bytes_written
+
+def server_model_version(http, url=server_url, model=model_name):
+    # Version reported by the server's /info/ endpoint (as served by MONAI Label), or None if it reports none
+    info_url = url.split('/infer/')[0].rstrip('/') + '/info/'
+    try:
+        response = http.get(info_url, timeout=30)
+        response.raise_for_status()
+        info = response.json()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logging.warning(f"Could not read the model version from {info_url}: {e}")
+        return None
+    version = info.get('models', {}).get(model, {}).get('version') or info.get('version')
+    return None if version is None else str(version)
+
+def load_manifest(path):
+    # Returns ({cache key: record}, {input path: record}); later records win and a torn last line is ignored
+    by_key, by_input = {}, {}
+    if not os.path.exists(path):
+        return by_key, by_input
+    with open(path) as f:
+        for line in f:
             try:
-                with http.post(server_url, files=files, data=data) as response:
-                    response.raise_for_status()
-                    stripped_content = strip_multipart_headers(response.content)
-                    if stripped_content:
-                        output_path = os.path.join(output_dir, img_name)
-                        with open(output_path, 'wb') as f:
-                            f.write(stripped_content)
-                            logging.info(f"{img_name} saved to output directory.")
-                    else:
-                        logging.error(f"Failed to strip headers for {img_name}")
-            except requests.exceptions.RequestException as e:
-                logging.error(f"Failed to process {img_name}: {e}")
-except Exception as e:
-    logging.critical(f"An error occurred: {e}")
-finally:
-    http.close()
-
-logging.info("Batch inference completed.")
+                record = json.loads(line)
+            except ValueError:
+                continue
+            by_key[record['key']] = record
+            by_input[record['input']] = record
+    return by_key, by_input
+
+def open_manifest(path):
+    # Opens the manifest for appending, first terminating a line torn by an interrupted run
+    manifest_file = open(path, 'a+b')
+    if manifest_file.tell() > 0:
+        manifest_file.seek(-1, os.SEEK_END)
+        if manifest_file.read(1) != b'\n':
+            manifest_file.write(b'\n')
+    return manifest_file
+
+def append_manifest(manifest_file, record):
+    # One line per finished file, synced so a crash never loses a result that is already on disk
+    manifest_file.write((json.dumps(record) + '\n').encode())
+    manifest_file.flush()
+    os.fsync(manifest_file.fileno())
+
+def inference_key(input_sha256, model=model_name, version=None):
+    return hashlib.sha256(f"{input_sha256}\0{model}\0{version or ''}".encode()).hexdigest()
+
+def input_digest(img_path, known=None):
+    # sha256 of the input; a manifest record for the same path, size and mtime is trusted instead of re-reading the file
+    stat = os.stat(img_path)
+    if known is not None and known.get('input_size') == stat.st_size and known.get('input_mtime_ns') == stat.st_mtime_ns:
+        return known['input_sha256'], stat
+    return file_fingerprint(img_path, content_hash=True).split(':', 1)[1], stat
+
+def reuse_output(record, output_path):
+    # True when the cached result is on disk at output_path (copying it there if it was saved under another name)
+    cached_path = record['output']
+    if not os.path.exists(cached_path) or os.path.getsize(cached_path) != record['output_bytes']:
+        return False
+    if os.path.abspath(cached_path) != os.path.abspath(output_path):
+        tmp_path = temporary_path(output_path)
+        try:
+            shutil.copyfile(cached_path, tmp_path)
+            os.replace(tmp_path, output_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    return True
+
+def infer_cached(http, img_path, output_path, url=server_url, model=model_name, version=None, manifest=({}, {}), force=False, timer=NULL_TIMER):
+    # infer_file behind the cache. Returns (status, infer_file result or None, manifest record to append or None),
+    # status being 'cached', 'copied', 'inferred' or 'no image part'
+    timer.start()
+    by_key, by_input = manifest
+    with timer.stage('hash'):
+        input_sha256, stat = input_digest(img_path, by_input.get(os.path.abspath(img_path)))
+    key = inference_key(input_sha256, model, version)
+    record = {
+        'key': key, 'input': os.path.abspath(img_path), 'input_sha256': input_sha256,
+        'input_size': stat.st_size, 'input_mtime_ns': stat.st_mtime_ns,
+        'model': model, 'model_version': version, 'output': os.path.abspath(output_path),
+    }
+
+    if not force:
+        # This file's own result first, then the result for identical content saved under another name
+        own = by_input.get(record['input'])
+        if own is not None and own['key'] == key and own['output'] == record['output'] and reuse_output(own, output_path):
+            # Record the new mtime of a touched but unchanged input, so it is not hashed again next time
+            unchanged = own['input_size'] == stat.st_size and own['input_mtime_ns'] == stat.st_mtime_ns
+            return 'cached', None, None if unchanged else dict(own, input_mtime_ns=stat.st_mtime_ns)
+        cached = by_key.get(key)
+        if cached is not None and reuse_output(cached, output_path):
+            return 'copied', None, dict(record, output_bytes=cached['output_bytes'], created=time.time())
+
+    result = infer_file(http, img_path, output_path, url, model, timer)
+    if result is None:
+        return 'no image part', None, None
+    return 'inferred', result, dict(record, output_bytes=result[2], created=time.time())
+
+def run_batch(input_dir, output_dir, concurrency=concurrency, url=server_url, model=model_name,
+              report_jsonl=report_jsonl, report_prometheus=report_prometheus,
+              manifest_path=manifest_path, model_version=model_version, query_model_version=query_model_version, force=False):
+    # Files whose input, model and model version match a manifest record with its output still on disk are skipped;
+    # force=True sends every file again (and records the new results)
+    # Ensure output directory exists
+    os.makedirs(output_dir, exist_ok=True)
+    img_names = sorted(f for f in os.listdir(input_dir) if os.path.isfile(os.path.join(input_dir, f)))
+    manifest_path = manifest_path or os.path.join(output_dir, MANIFEST_NAME)
+    manifest = load_manifest(manifest_path)
+
+    with RunReport('batch_inference', report_jsonl, report_prometheus) as report:
+        timers = {img_name: report.case(img_name) for img_name in img_names}
+        http = create_session(concurrency)
+        if query_model_version:
+            model_version = server_model_version(http, url, model) or model_version
+        logging.info(f"{len(manifest[0])} results in manifest {manifest_path} (model {model}, version {model_version})")
+        latencies = []
+        bytes_sent = 0
+        n_cached = 0
+        start = time.perf_counter()
+        try:
+            # The thread count bounds the number of requests in flight
+            with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor, open_manifest(manifest_path) as manifest_file:
+                futures = {
+                    executor.submit(
+                        infer_cached, http, os.path.join(input_dir, img_name), os.path.join(output_dir, img_name),
+                        url, model, model_version, manifest, force, timers[img_name],
+                    ): img_name
+                    for img_name in img_names
+                }
+                for future in as_completed(futures):
+                    img_name = futures[future]
+                    try:
+                        status, result, record = future.result()
+                    except requests.exceptions.RequestException as e:
+                        logging.error(f"Failed to process {img_name}: {e}")
+                        report.record(timers[img_name].finish('error'))
+                        continue
+                    if record is not None:
+                        append_manifest(manifest_file, record)
+                    report.record(timers[img_name].finish('ok' if status == 'inferred' else status))
+                    if status in ('cached', 'copied'):
+                        n_cached += 1
+                        logging.info(f"{img_name} already inferred, skipped")
+                    if result is not None:
+                        latencies.append(result[0])
+                        bytes_sent += result[1]
+        except Exception as e:
+            logging.critical(f"An error occurred: {e}")
+        finally:
+            http.close()
+
+    elapsed = time.perf_counter() - start
+    if latencies:
+        logging.info(
+            f"{len(latencies)}/{len(img_names)} files in {elapsed:.1f} s "
+            f"({len(latencies) / elapsed:.2f} files/s, {bytes_sent / 1e6 / elapsed:.1f} MB/s uploaded, "
+            f"mean latency {sum(latencies) / len(latencies):.2f} s, concurrency {concurrency})"
+        )
+    if n_cached:
+        logging.info(f"{n_cached}/{len(img_names)} files were already inferred and skipped")
+    logging.info("Batch inference completed.")
+    return latencies
+
+if __name__ == "__main__":
+    run_batch(input_dir, output_dir, concurrency, report_jsonl=report_jsonl, report_prometheus=report_prometheus)
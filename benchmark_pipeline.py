@@ -0,0 +1,299 @@
+import os
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import nibabel as nib
+import SimpleITK as sitk
+
+# Synthetic-phantom benchmarks for the pipeline stages.
+# Label volumes are generated deterministically (ellipsoids and spheres whose predicted copies are shifted and scaled
+# by a controlled amount), so runs are comparable between commits and no patient data is needed.
+#
+#   python benchmark_pipeline.py --sizes 192 256 --output bench_new.json
+#   python benchmark_pipeline.py --compare bench_old.json bench_new.json
+
+# Voxel spacing (mm) written into every phantom
+PHANTOM_SPACING = (1.0, 1.0, 1.0)
+
+# Number of anatomy labels painted into each phantom (the merger remaps up to 16)
+PHANTOM_LABELS = 16
+
+# File formats each stage can read
+STAGE_FORMATS = {
+    'calculate_metrics': ['.nii.gz'],
+    'calculate_hausdorff_3d': ['.nii.gz'],
+    'process_file': ['.nii', '.nii.gz'],
+    'remap_labels': ['.nii.gz'],
+    'merge_pair': ['.nii.gz', '.nrrd'],
+    'convert_to_int16': ['.nii', '.nii.gz'],
+}
+
+
+def ellipsoid_mask(grids, center, radii):
+    return sum(((g - c) / r) ** 2 for g, c, r in zip(grids, center, radii)) <= 1
+
+
+# Ground truth and prediction label maps: each label is an ellipsoid (every other one a sphere), and its predicted
+# copy is displaced by `shift` voxels on average and rescaled by up to `scale_jitter`, which controls the overlap
+def make_phantom_pair(shape, n_labels=PHANTOM_LABELS, seed=0, shift=2.0, scale_jitter=0.1):
+    rng = np.random.default_rng(seed)
+    grids = np.ogrid[tuple(slice(0, n) for n in shape)]
+    ground_truth = np.zeros(shape, dtype=np.uint8)
+    prediction = np.zeros(shape, dtype=np.uint8)
+    for label in range(1, n_labels + 1):
+        center = rng.uniform(0.3, 0.7, 3) * shape
+        if label % 2:
+            radii = np.full(3, rng.uniform(0.06, 0.15) * min(shape))
+        else:
+            radii = rng.uniform(0.06, 0.2, 3) * min(shape)
+        ground_truth[ellipsoid_mask(grids, center, radii)] = label
+        offset = rng.normal(0, shift, 3)
+        scale = 1 + rng.uniform(-scale_jitter, scale_jitter, 3)
+        prediction[ellipsoid_mask(grids, center + offset, radii * scale)] = label
+    return ground_truth, prediction
+
+
+def save_phantom(arr, path, dtype):
+    arr = arr.astype(dtype)
+    if path.endswith('.nrrd'):
+        # SimpleITK arrays are indexed (z, y, x)
+        img = sitk.GetImageFromArray(arr.transpose(2, 1, 0))
+        img.SetSpacing(PHANTOM_SPACING)
+        sitk.WriteImage(img, path)
+    else:
+        nib.save(nib.Nifti1Image(arr, np.diag(PHANTOM_SPACING + (1.0,))), path)
+
+
+def write_phantom_cases(directory, shape, dtype, extension, n_cases=1):
+    # Writes n_cases phantom pairs as gt/<case><ext>, pred/<case><ext> and an infarct map ich/<case><ext>
+    for sub in ('gt', 'pred', 'ich'):
+        os.makedirs(os.path.join(directory, sub), exist_ok=True)
+    names = []
+    for case in range(n_cases):
+        name = f"case{case:03d}{extension}"
+        ground_truth, prediction = make_phantom_pair(shape, seed=case)
+        save_phantom(ground_truth, os.path.join(directory, 'gt', name), dtype)
+        save_phantom(prediction, os.path.join(directory, 'pred', name), dtype)
+        save_phantom(ground_truth == 1, os.path.join(directory, 'ich', name), dtype)
+        names.append(name)
+    return names
+
+
+# Stage runners execute inside a fresh process; each returns the wall time of the timed call only
+def _time_stage(stage, directory, name):
+    gt_path = os.path.join(directory, 'gt', name)
+    pred_path = os.path.join(directory, 'pred', name)
+
+    if stage in ('calculate_metrics', 'calculate_hausdorff_3d'):
+        import segmentation_stats_with_flatten_function_parallelised_v2 as stats
+        from volume_io import load_volume
+        ground_truth, header = load_volume(gt_path)
+        prediction, _ = load_volume(pred_path)
+        gt_mask = (ground_truth == 1).astype(int)
+        pred_mask = (prediction == 1).astype(int)
+        spacing = header.get_zooms()[:3]
+        func = getattr(stats, stage)
+        # Warm-up call on a small mask of the same dtype, so numba compilation / cache loading is not part of the timing
+        warm_up = np.ones((4, 4, 4), dtype=gt_mask.dtype)
+        func(warm_up, warm_up, spacing)
+        start = time.perf_counter()
+        func(gt_mask, pred_mask, spacing)
+    elif stage == 'process_file':
+        import segmentation_stats_with_flatten_function_parallelised_v2 as stats
+        stats.process_file(name, os.path.join(directory, 'gt'), os.path.join(directory, 'pred'))
+        start = time.perf_counter()
+        stats.process_file(name, os.path.join(directory, 'gt'), os.path.join(directory, 'pred'))
+    elif stage == 'remap_labels':
+        import kenanatlabelmerger
+        arr = sitk.GetArrayFromImage(sitk.ReadImage(gt_path))
+        mapping = kenanatlabelmerger.label_mapping(kenanatlabelmerger.segment_dict1)
+        start = time.perf_counter()
+        kenanatlabelmerger.remap_labels(arr, mapping)
+    elif stage == 'merge_pair':
+        import kenanatlabelmerger
+        output_folder = os.path.join(directory, 'merged')
+        os.makedirs(output_folder, exist_ok=True)
+        start = time.perf_counter()
+        kenanatlabelmerger.merge_pair(gt_path, os.path.join(directory, 'ich', name), output_folder)
+    elif stage == 'convert_to_int16':
+        import ConvertTo16Bit
+        output_folder = os.path.join(directory, 'int16')
+        os.makedirs(output_folder, exist_ok=True)
+        start = time.perf_counter()
+        ConvertTo16Bit.convert_to_int16(gt_path, os.path.join(output_folder, name))
+    else:
+        raise ValueError(f"Unknown stage {stage}")
+    return time.perf_counter() - start
+
+
+def _run_stage(stage, directory, name):
+    from volume_io import peak_rss_mb
+    wall = _time_stage(stage, directory, name)
+    return wall, peak_rss_mb()
+
+
+def _run_stats_main(directory, max_workers):
+    # Returns (wall time, peak RSS of the pool workers, which do the work, or of this process if they cannot report it)
+    import segmentation_stats_with_flatten_function_parallelised_v2 as stats
+    from volume_io import peak_rss_mb
+    gt_dir, pred_dir = os.path.join(directory, 'gt'), os.path.join(directory, 'pred')
+    output_csv = os.path.join(directory, f"stats_{max_workers}.csv")
+    # Warm-up call before the timer (forked workers inherit the loaded modules and compiled kernels)
+    stats.process_file(sorted(os.listdir(gt_dir))[0], gt_dir, pred_dir)
+    start = time.perf_counter()
+    summary = stats.main(gt_dir, pred_dir, output_csv, cache_dir=os.path.join(directory, 'cache'), force=True, max_workers=max_workers)
+    wall = time.perf_counter() - start
+    return wall, summary['worker_peak_rss_mb'] if summary['worker_peak_rss_mb'] is not None else peak_rss_mb()
+
+
+def run_isolated(func, *args):
+    # A fresh spawned process per measurement keeps imports, JIT caches and peak RSS from leaking between runs
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(func, *args).result()
+
+
+def result_key(result):
+    return (result['stage'], tuple(result['shape']), result['dtype'], result['format'], result.get('workers'))
+
+
+def run_benchmarks(sizes, dtypes, stages, worker_counts, n_cases, repeat):
+    results = []
+    with tempfile.TemporaryDirectory(prefix='segbench_') as root:
+        for size in sizes:
+            shape = (size, size, size)
+            for dtype in dtypes:
+                extensions = sorted({ext for stage in stages for ext in STAGE_FORMATS[stage]})
+                for extension in extensions:
+                    directory = os.path.join(root, f"{size}_{dtype}_{extension.lstrip('.').replace('.', '_')}")
+                    name = write_phantom_cases(directory, shape, dtype, extension)[0]
+                    for stage in stages:
+                        if extension not in STAGE_FORMATS[stage]:
+                            continue
+                        runs = [run_isolated(_run_stage, stage, directory, name) for _ in range(repeat)]
+                        wall = min(run[0] for run in runs)
+                        peak = max((run[1] for run in runs if run[1] is not None), default=None)
+                        results.append({
+                            'stage': stage, 'shape': list(shape), 'dtype': dtype, 'format': extension, 'workers': None,
+                            'wall_s': wall, 'voxels': int(np.prod(shape)), 'voxels_per_s': float(np.prod(shape)) / wall,
+                            'peak_rss_mb': peak,
+                        })
+                        print(f"{stage:24s} {size}^3 {dtype:8s} {extension:8s} {wall:8.3f} s  "
+                              f"{results[-1]['voxels_per_s'] / 1e6:8.1f} Mvox/s  peak RSS {peak or float('nan'):.0f} MB")
+
+            # Worker scaling of the stats ProcessPoolExecutor over a small phantom cohort
+            if worker_counts:
+                directory = os.path.join(root, f"{size}_scaling")
+                write_phantom_cases(directory, shape, 'uint8', '.nii.gz', n_cases=n_cases)
+                for workers in worker_counts:
+                    runs = [run_isolated(_run_stats_main, directory, workers) for _ in range(repeat)]
+                    wall = min(run[0] for run in runs)
+                    voxels = int(np.prod(shape)) * n_cases
+                    results.append({
+                        'stage': 'stats_main', 'shape': list(shape), 'dtype': 'uint8', 'format': '.nii.gz', 'workers': workers,
+                        'cases': n_cases, 'wall_s': wall, 'voxels': voxels, 'voxels_per_s': voxels / wall,
+                        'peak_rss_mb': max((run[1] for run in runs if run[1] is not None), default=None),
+                    })
+                    print(f"{'stats_main':24s} {size}^3 x{n_cases} workers={workers:<3d} {wall:8.3f} s  {voxels / wall / 1e6:8.1f} Mvox/s")
+    return results
+
+
+# Label values moved to the ends of each dtype's range by the label store check, where offset arithmetic in the
+# source dtype would wrap around
+CHECK_LABEL_VALUES = {
+    'uint8': {16: 255},
+    'int16': {15: -7, 16: 32767},
+}
+
+
+def check_label_store(size=64):
+    # Stats rows computed through label stores must equal the rows computed from the NIfTI files
+    import segmentation_stats_with_flatten_function_parallelised_v2 as stats
+
+    def comparable(rows):
+        return [[None if isinstance(value, float) and np.isnan(value) else value for value in row] for row in rows]
+
+    ok = True
+    with tempfile.TemporaryDirectory(prefix='segcheck_') as directory:
+        for dtype, moves in CHECK_LABEL_VALUES.items():
+            name = f"check_{dtype}.nii.gz"
+            for sub, labels in zip(('gt', 'pred'), make_phantom_pair((size, size, size))):
+                labels = labels.astype(np.int64)
+                for old, new in moves.items():
+                    labels[labels == old] = new
+                os.makedirs(os.path.join(directory, sub), exist_ok=True)
+                save_phantom(labels, os.path.join(directory, sub, name), dtype)
+            gt_dir, pred_dir = os.path.join(directory, 'gt'), os.path.join(directory, 'pred')
+            from_files = stats.process_file(name, gt_dir, pred_dir)['rows']
+            from_stores = stats.process_file(name, gt_dir, pred_dir, label_store_dir=os.path.join(directory, 'stores'))['rows']
+            same = bool(from_files) and comparable(from_files) == comparable(from_stores)
+            ok = ok and same
+            print(f"label store check {dtype:8s} labels {sorted(moves.values())}: {'ok' if same else 'MISMATCH'}")
+    return ok
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline_path, candidate_path):
+    with open(baseline_path) as f:
+        baseline = {result_key(r): r for r in json.load(f)['results']}
+    with open(candidate_path) as f:
+        candidate = json.load(f)['results']
+    print(f"{'stage':24s} {'shape':>12s} {'dtype':8s} {'format':8s} {'workers':>7s} {'base s':>9s} {'new s':>9s} {'speedup':>8s}")
+    for result in candidate:
+        base = baseline.get(result_key(result))
+        if base is None:
+            continue
+        shape = 'x'.join(str(n) for n in result['shape'])
+        workers = '' if result.get('workers') is None else str(result['workers'])
+        print(f"{result['stage']:24s} {shape:>12s} {result['dtype']:8s} {result['format']:8s} {workers:>7s} "
+              f"{base['wall_s']:9.3f} {result['wall_s']:9.3f} {base['wall_s'] / result['wall_s']:7.2f}x")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the segmentation pipeline stages on synthetic phantoms")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[192], help="edge length of the cubic phantoms")
+    parser.add_argument('--dtypes', nargs='+', default=['uint8', 'int16', 'float32'])
+    parser.add_argument('--stages', nargs='+', default=list(STAGE_FORMATS), choices=list(STAGE_FORMATS))
+    parser.add_argument('--workers', type=int, nargs='*', default=[1, 2, 4], help="worker counts for the stats scaling run (none to skip)")
+    parser.add_argument('--cases', type=int, default=8, help="phantom cases in the scaling run")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per measurement; the fastest is kept")
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CANDIDATE'), help="compare two result files and exit")
+    parser.add_argument('--check-label-store', action='store_true', help="check label store stats against the NIfTI files and exit")
+    args = parser.parse_args(argv)
+
+    if args.check_label_store:
+        raise SystemExit(0 if check_label_store() else 1)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    results = run_benchmarks(args.sizes, args.dtypes, args.stages, args.workers, args.cases, args.repeat)
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Benchmark results have been saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
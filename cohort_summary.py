@@ -0,0 +1,192 @@
+import csv
+import time
+import warnings
+import numpy as np
+
+# Cohort-level summary of the per-case CSV written by segmentation_stats_with_flatten_function_parallelised_v2.py.
+#
+# For every segmentation label:
+#   micro averages  Dice/IoU/precision/recall from TP, FP and FN summed over cases
+#   macro averages  the mean of the per-case metrics (NaN cases, e.g. an undefined Hausdorff distance, are skipped)
+#   volume agreement between GT and predicted segment volumes: Bland-Altman bias and limits of agreement,
+#                   Pearson correlation and ICC(2,1) (two-way random effects, absolute agreement, single measure)
+# Each statistic gets a percentile bootstrap confidence interval over cases.
+#
+# Every statistic above is a function of a few per-case sums (TP, x, x^2, x*y, ...). A bootstrap resample is just a
+# count of how often each case was drawn, so all resamples are one (n_bootstrap, n_cases) multinomial count matrix,
+# drawn once and shared by every label, and each label's sums are a single matrix product with its
+# (n_cases, n_moments) matrix of per-case values.
+
+# Define input and output paths
+input_csv = '/Users/jamesdowney/Library/CloudStorage/OneDrive-Personal/UNI/UNSW/Phase 2/Honours/Stats/rerun_path/anatomy_flat.csv'
+output_csv = '/Users/jamesdowney/Library/CloudStorage/OneDrive-Personal/UNI/UNSW/Phase 2/Honours/Stats/rerun_path/anatomy_flat_cohort_summary.csv'
+
+# Bootstrap resamples, confidence level and random seed (fixed so summaries are reproducible)
+n_bootstrap = 5000
+confidence = 0.95
+seed = 0
+
+# Per-case CSV columns used here
+INPUT_COLUMNS = {
+    'dice': 'Dice',
+    'iou': 'IoU (Jaccard Index)',
+    'precision': 'Precision',
+    'recall': 'Recall',
+    'f1': 'F1 Score',
+    'hd': 'Hausdorff Distance (mm)',
+    'hd95': 'HD95 (mm)',
+    'assd': 'ASSD (mm)',
+    'gt_count': 'Ground Truth Voxel Count',
+    'pred_count': 'Inference Voxel Count',
+    'gt_volume': 'Ground Truth Segment Volume (cm^3)',
+    'pred_volume': 'Inference Segment Volume (cm^3)',
+}
+
+# Per-case metrics that are macro-averaged
+MACRO_METRICS = {
+    'dice': 'Macro Dice',
+    'iou': 'Macro IoU',
+    'precision': 'Macro Precision',
+    'recall': 'Macro Recall',
+    'f1': 'Macro F1 Score',
+    'hd': 'Macro Hausdorff Distance (mm)',
+    'hd95': 'Macro HD95 (mm)',
+    'assd': 'Macro ASSD (mm)',
+}
+
+CSV_HEADER = ['Segmentation Label', 'Statistic', 'Estimate', 'CI Lower', 'CI Upper', 'Cases']
+
+
+def read_case_rows(input_csv):
+    # (cases, {label: {column key: float array over all cases}}), labels in order of first appearance.
+    # Cases without a row for a label are NaN in every column of that label.
+    case_index = {}
+    values = {}
+    with open(input_csv, newline='') as file:
+        for row in csv.DictReader(file):
+            case = case_index.setdefault(row['Case'], len(case_index))
+            label = values.setdefault(row['Segmentation Label'], {})
+            label[case] = [float(row[name]) if row.get(name) not in ('', None) else np.nan for name in INPUT_COLUMNS.values()]
+    columns = {}
+    for label, rows in values.items():
+        table = np.full((len(case_index), len(INPUT_COLUMNS)), np.nan)
+        table[list(rows)] = list(rows.values())
+        columns[label] = dict(zip(INPUT_COLUMNS, table.T))
+    return list(case_index), columns
+
+
+def confusion_counts(columns):
+    # TP, FP and FN per case from the voxel counts and Dice: Dice = 2 TP / (|GT| + |P|)
+    tp = np.rint(columns['dice'] * (columns['gt_count'] + columns['pred_count']) / 2)
+    return tp, columns['pred_count'] - tp, columns['gt_count'] - tp
+
+
+def case_moments(columns):
+    # {name: per-case value}; every cohort statistic is computed from sums of these over (resampled) cases.
+    # Missing values contribute 0 to the sums and are left out of the matching case counts.
+    tp, fp, fn = confusion_counts(columns)
+    moments = {'tp': np.nan_to_num(tp), 'fp': np.nan_to_num(fp), 'fn': np.nan_to_num(fn)}
+    for key in MACRO_METRICS:
+        valid = ~np.isnan(columns[key])
+        moments[key] = np.where(valid, columns[key], 0.0)
+        moments[f'{key}_n'] = valid.astype(float)
+    present = ~(np.isnan(columns['gt_volume']) | np.isnan(columns['pred_volume']))
+    gt_volume, pred_volume = np.where(present, columns['gt_volume'], 0.0), np.where(present, columns['pred_volume'], 0.0)
+    moments.update({
+        'n': present.astype(float),
+        'x': gt_volume, 'y': pred_volume,
+        'xx': gt_volume ** 2, 'yy': pred_volume ** 2, 'xy': gt_volume * pred_volume,
+    })
+    return moments
+
+
+def _ratio(numerator, denominator):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(denominator > 0, numerator / denominator, np.nan)
+
+
+def icc_2_1(n, sx, sy, sxx, syy, sxy):
+    # ICC(2,1) for two raters from the sums of their ratings, squares and cross products over n cases
+    grand_mean = _ratio(sx + sy, 2 * n)
+    ss_total = sxx + syy - 2 * n * grand_mean ** 2
+    ss_rows = 2 * ((sxx + 2 * sxy + syy) / 4 - n * grand_mean ** 2)
+    ss_cols = n * ((_ratio(sx, n) - grand_mean) ** 2 + (_ratio(sy, n) - grand_mean) ** 2)
+    ms_rows = _ratio(ss_rows, n - 1)
+    ms_cols = ss_cols
+    ms_error = _ratio(ss_total - ss_rows - ss_cols, n - 1)
+    return _ratio(ms_rows - ms_error, ms_rows + ms_error + 2 * _ratio(ms_cols - ms_error, n))
+
+
+def cohort_statistics(sums):
+    # {statistic name: value} from moment sums; sums may carry a leading resample axis
+    tp, fp, fn = sums['tp'], sums['fp'], sums['fn']
+    statistics = {
+        'Micro Dice': _ratio(2 * tp, 2 * tp + fp + fn),
+        'Micro IoU': _ratio(tp, tp + fp + fn),
+        'Micro Precision': _ratio(tp, tp + fp),
+        'Micro Recall': _ratio(tp, tp + fn),
+    }
+    for key, name in MACRO_METRICS.items():
+        statistics[name] = _ratio(sums[key], sums[f'{key}_n'])
+
+    n, sx, sy, sxx, syy, sxy = sums['n'], sums['x'], sums['y'], sums['xx'], sums['yy'], sums['xy']
+    bias = _ratio(sy - sx, n)
+    # Sample standard deviation of the differences y - x
+    spread = 1.96 * np.sqrt(np.maximum(_ratio((syy - 2 * sxy + sxx) - n * bias ** 2, n - 1), 0))
+    statistics.update({
+        'Mean GT Volume (cm^3)': _ratio(sx, n),
+        'Mean Predicted Volume (cm^3)': _ratio(sy, n),
+        'Volume Bias (cm^3)': bias,
+        'Volume Lower Limit of Agreement (cm^3)': bias - spread,
+        'Volume Upper Limit of Agreement (cm^3)': bias + spread,
+        'Volume Pearson r': _ratio(sxy - sx * _ratio(sy, n), np.sqrt(np.maximum((sxx - sx * _ratio(sx, n)) * (syy - sy * _ratio(sy, n)), 0))),
+        'Volume ICC(2,1)': icc_2_1(n, sx, sy, sxx, syy, sxy),
+    })
+    return statistics
+
+
+def bootstrap_draws(n_cases, rng, n_bootstrap=n_bootstrap):
+    # (n_bootstrap, n_cases) matrix: how often each case is drawn in each resample
+    return rng.multinomial(n_cases, np.full(n_cases, 1 / n_cases), size=n_bootstrap).astype(float)
+
+
+def summarise_label(columns, draws=None, confidence=confidence):
+    # [(statistic, estimate, CI lower, CI upper)] with percentile bootstrap CIs over the resamples in draws
+    moments = case_moments(columns)
+    names = list(moments)
+    matrix = np.column_stack([moments[name] for name in names])
+    estimates = cohort_statistics(dict(zip(names, matrix.sum(axis=0))))
+    if draws is not None and len(draws):
+        # Every resample's sums in one matrix product
+        resampled = cohort_statistics(dict(zip(names, (draws @ matrix).T)))
+        tail = 100 * (1 - confidence) / 2
+        with warnings.catch_warnings():
+            # Statistics that are NaN in every resample get a NaN interval without a warning
+            warnings.simplefilter('ignore', RuntimeWarning)
+            intervals = {name: np.nanpercentile(values, [tail, 100 - tail]) for name, values in resampled.items()}
+    else:
+        intervals = {name: (np.nan, np.nan) for name in estimates}
+    return [(name, float(estimate), *map(float, intervals[name])) for name, estimate in estimates.items()]
+
+
+def main(input_csv=input_csv, output_csv=output_csv, n_bootstrap=n_bootstrap, confidence=confidence, seed=seed):
+    start = time.perf_counter()
+    cases, columns_per_label = read_case_rows(input_csv)
+    # Cases are resampled together, so every label sees the same bootstrap cohorts
+    draws = bootstrap_draws(len(cases), np.random.default_rng(seed), n_bootstrap) if n_bootstrap and len(cases) > 1 else None
+
+    with open(output_csv, mode='w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(CSV_HEADER)
+        for label, columns in columns_per_label.items():
+            n_cases = int((~np.isnan(columns['gt_volume'])).sum())
+            # A label seen in fewer than two cases has no meaningful bootstrap interval
+            label_draws = draws if n_cases > 1 else None
+            for statistic, estimate, lower, upper in summarise_label(columns, label_draws, confidence):
+                writer.writerow([label, statistic, estimate, lower, upper, n_cases])
+
+    print(f"Cohort summary of {len(columns_per_label)} labels saved to {output_csv} ({time.perf_counter() - start:.2f} s)")
+
+
+if __name__ == "__main__":
+    main()
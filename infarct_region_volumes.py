@@ -0,0 +1,167 @@
+import os
+import csv
+import glob
+import numpy as np
+import SimpleITK as sitk
+from concurrent.futures import ProcessPoolExecutor
+from kenanatlabelmerger import (
+    segment_dict1, segment_dict2, semantic_dict, label_mapping, remap_labels,
+    get_root_filename, index_by_root_filename, read_segmentation,
+)
+
+# Infarct volume per anatomical region, from the unmerged anatomy and infarct label maps.
+# kenanatlabelmerger.py overwrites anatomy with the infarct label (np.maximum), which loses the region an infarct
+# lies in; here both maps are remapped the same way as in the merger and counted together in one joint histogram.
+
+# Anatomy and infarct folders per source (cases are matched on their root filename)
+sources = {
+    "GT": (
+        "D:/Matlab Registration Code/NCCT_Anatomy20SeptInt/NCCT_Anatomy20SeptInt/Cropped/labelmerger/UnmergedAnat",
+        "D:/Matlab Registration Code/NCCT_Anatomy20SeptInt/NCCT_Anatomy20SeptInt/Cropped/labelmerger/Ischemic",
+    ),
+    "Prediction": (
+        "D:/Matlab Registration Code/NCCT_Anatomy20SeptInt/NCCT_Anatomy20SeptInt/Cropped/labelmerger/PredictedAnat",
+        "D:/Matlab Registration Code/NCCT_Anatomy20SeptInt/NCCT_Anatomy20SeptInt/Cropped/labelmerger/PredictedIschemic",
+    ),
+}
+output_csv = "D:/Matlab Registration Code/NCCT_Anatomy20SeptInt/NCCT_Anatomy20SeptInt/Cropped/labelmerger/infarct_region_volumes.csv"
+
+# Optional label maps keeping anatomy and infarct together, written per source and case (None to skip).
+# 'bitpacked' stores anatomy + INFARCT_BIT * infarct in one uint8 volume; 'multichannel' stores a 2-component
+# vector image (component 0 anatomy, component 1 infarct).
+combined_output_folder = None
+combined_format = "bitpacked"
+
+# Number of cases processed in parallel
+max_workers = os.cpu_count()
+
+# Optional directory of chunked label stores (see label_store.py) read instead of the raw files
+label_store_dir = None
+
+# Label the infarct map is remapped to by segment_dict2
+INFARCT_LABEL = 13
+# Anatomy labels are 0-12, so the infarct flag fits in the next bit
+INFARCT_BIT = 16
+
+# Region names for the remapped anatomy labels
+REGION_NAMES = {int(segment.split("_")[1]): name for segment, name in semantic_dict.items()}
+REGION_NAMES[0] = "Outside Anatomy"
+
+CSV_HEADER = [
+    "Case",
+    "Source",
+    "Region Label",
+    "Region",
+    "Region Voxel Count",
+    "Infarct Voxel Count",
+    "Voxel Size (cm^3)",
+    "Region Volume (cm^3)",
+    "Infarct Volume (cm^3)",
+    "Infarct Fraction of Region",
+    "Fraction of Total Infarct",
+]
+
+
+# Region x infarct voxel counts in one pass: counts[region, 1] are infarct voxels in the region, counts[region, 0] the rest
+def region_infarct_histogram(anatomy, infarct):
+    if anatomy.shape != infarct.shape:
+        raise ValueError(f"Anatomy {anatomy.shape} and infarct {infarct.shape} label maps differ in shape")
+    anatomy = anatomy.astype(np.intp, copy=False)
+    if anatomy.min() < 0:
+        raise ValueError("Anatomy label map contains negative labels")
+    n_regions = int(anatomy.max()) + 1
+    counts = np.bincount((2 * anatomy + infarct).ravel(), minlength=2 * n_regions)
+    return counts.reshape(n_regions, 2)
+
+
+def pack_labels(anatomy, infarct):
+    return (anatomy + INFARCT_BIT * infarct).astype(np.uint8)
+
+
+def write_combined(anatomy, infarct, geometry, output_path, combined_format=combined_format):
+    if combined_format == "bitpacked":
+        image = sitk.GetImageFromArray(pack_labels(anatomy, infarct))
+    elif combined_format == "multichannel":
+        image = sitk.GetImageFromArray(np.stack([anatomy, infarct], axis=-1).astype(np.uint8), isVector=True)
+    else:
+        raise ValueError(f"Unknown combined_format {combined_format!r}")
+    image.SetSpacing(geometry["spacing"])
+    image.SetOrigin(geometry["origin"])
+    image.SetDirection(geometry["direction"])
+    sitk.WriteImage(image, output_path)
+
+
+# Table rows for one case of one source
+def region_volumes(anatomy_filename, infarct_filename, source, label_store_dir=None, combined_output_folder=None, combined_format=combined_format):
+    case = get_root_filename(anatomy_filename)
+    anatomy, geometry = read_segmentation(anatomy_filename, label_store_dir)
+    infarct, _ = read_segmentation(infarct_filename, label_store_dir)
+    anatomy = remap_labels(anatomy, label_mapping(segment_dict1))
+    infarct = (remap_labels(infarct, label_mapping(segment_dict2)) == INFARCT_LABEL).astype(np.uint8)
+
+    counts = region_infarct_histogram(anatomy, infarct)
+    voxel_size = np.prod(geometry["spacing"]) / 1000
+    total_infarct = counts[:, 1].sum()
+
+    rows = []
+    for label, (outside, inside) in enumerate(counts):
+        region_count = outside + inside
+        if region_count == 0:
+            continue
+        rows.append([
+            case,
+            source,
+            label,
+            REGION_NAMES.get(label, f"Label {label}"),
+            region_count,
+            inside,
+            voxel_size,
+            voxel_size * region_count,
+            voxel_size * inside,
+            inside / region_count,
+            inside / total_infarct if total_infarct else 0.0,
+        ])
+
+    if combined_output_folder is not None:
+        folder = os.path.join(combined_output_folder, source)
+        os.makedirs(folder, exist_ok=True)
+        write_combined(anatomy, infarct, geometry, os.path.join(folder, case + ".nrrd"), combined_format)
+    return rows
+
+
+def main():
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = []
+        for source, (anatomy_folder, infarct_folder) in sources.items():
+            anatomy_filenames = sorted(
+                glob.glob(os.path.join(anatomy_folder, "*.nii.gz")) + glob.glob(os.path.join(anatomy_folder, "*.nrrd"))
+            )
+            infarct_index = index_by_root_filename(sorted(
+                glob.glob(os.path.join(infarct_folder, "*.nii.gz")) + glob.glob(os.path.join(infarct_folder, "*.nrrd"))
+            ))
+            for anatomy_filename in anatomy_filenames:
+                infarct_filename = infarct_index.get(get_root_filename(anatomy_filename))
+                if infarct_filename is None:
+                    print(f"Could not find matching infarct segmentation for {get_root_filename(anatomy_filename)} ({source})")
+                    continue
+                future = executor.submit(
+                    region_volumes, anatomy_filename, infarct_filename, source,
+                    label_store_dir, combined_output_folder, combined_format,
+                )
+                pending.append((anatomy_filename, source, future))
+
+        # Rows are written in source and case order
+        with open(output_csv, "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(CSV_HEADER)
+            for anatomy_filename, source, future in pending:
+                try:
+                    writer.writerows(future.result())
+                except Exception as e:
+                    print(f"Error processing {anatomy_filename} ({source}): {e}")
+
+    print(f"Infarct volumes per region have been saved to {output_csv}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+import os
+import json
+import time
+import uuid
+import threading
+from contextlib import nullcontext
+from volume_io import peak_rss_mb
+
+# Lightweight per-stage instrumentation shared by the pipeline scripts.
+#
+# A CaseTimer lives wherever a case is processed (often a worker process). It times named stages with
+# `with timer.stage("load"): ...`, counts bytes read and written, and turns into a plain dict with finish(),
+# which is what workers send back. The parent feeds those dicts to a RunReport, which appends them to a
+# JSON-lines file and, on close, writes run totals and an optional Prometheus text-format file.
+#
+# When disabled, stage() hands back one shared no-op context manager and the byte counters return immediately,
+# so instrumented code costs an attribute check per call.
+
+_NULL_STAGE = nullcontext()
+
+
+class _Stage:
+    __slots__ = ('timer', 'name', 'start')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        stages = self.timer.stages
+        stages[self.name] = stages.get(self.name, 0.0) + time.perf_counter() - self.start
+        return False
+
+
+class CaseTimer:
+    def __init__(self, case, enabled=True):
+        self.case = case
+        self.enabled = enabled
+        self.stages = {}
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.fields = {}
+        self._start = time.perf_counter() if enabled else None
+
+    def start(self):
+        # Restarts the wall clock, for timers created before their case leaves a queue
+        if self.enabled:
+            self._start = time.perf_counter()
+
+    def stage(self, name):
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def read_file(self, path):
+        if self.enabled and os.path.exists(path):
+            self.bytes_read += os.path.getsize(path)
+
+    def wrote_file(self, path):
+        if self.enabled and os.path.exists(path):
+            self.bytes_written += os.path.getsize(path)
+
+    def add_bytes(self, read=0, written=0):
+        if self.enabled:
+            self.bytes_read += read
+            self.bytes_written += written
+
+    def set(self, **fields):
+        if self.enabled:
+            self.fields.update(fields)
+
+    def finish(self, status='ok'):
+        # The case record, or None when disabled
+        if not self.enabled:
+            return None
+        return dict(
+            self.fields,
+            case=self.case,
+            status=status,
+            wall_s=time.perf_counter() - self._start,
+            stages=dict(self.stages),
+            bytes_read=self.bytes_read,
+            bytes_written=self.bytes_written,
+            peak_rss_mb=peak_rss_mb(),
+        )
+
+
+# A disabled timer for code paths that were not asked to instrument anything
+NULL_TIMER = CaseTimer(None, enabled=False)
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class RunReport:
+    def __init__(self, script, jsonl_path=None, prometheus_path=None):
+        self.script = script
+        self.jsonl_path = jsonl_path
+        self.prometheus_path = prometheus_path
+        self.enabled = bool(jsonl_path or prometheus_path)
+        self.run_id = uuid.uuid4().hex[:12]
+        self._lock = threading.Lock()
+        self._file = open(jsonl_path, 'a') if jsonl_path else None
+        self._start = time.perf_counter()
+        self._run_timer = CaseTimer(None, enabled=self.enabled)
+        self.stage_seconds = {}
+        self.status_counts = {}
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.peak_rss_mb = None
+
+    def case(self, case):
+        return CaseTimer(case, enabled=self.enabled)
+
+    def stage(self, name):
+        # Times a phase that runs in the parent process (e.g. writing the output CSV)
+        return self._run_timer.stage(name)
+
+    def record(self, record):
+        # Accepts a CaseTimer.finish() dict from any process; None (instrumentation disabled) is ignored
+        if not self.enabled or record is None:
+            return
+        with self._lock:
+            for name, seconds in record['stages'].items():
+                self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + seconds
+            self.status_counts[record['status']] = self.status_counts.get(record['status'], 0) + 1
+            self.bytes_read += record['bytes_read']
+            self.bytes_written += record['bytes_written']
+            if record.get('peak_rss_mb') is not None:
+                self.peak_rss_mb = max(self.peak_rss_mb or 0.0, record['peak_rss_mb'])
+            if self._file is not None:
+                self._file.write(json.dumps(dict(record, event='case', script=self.script, run_id=self.run_id)) + '\n')
+
+    def summary(self):
+        stage_seconds = dict(self.stage_seconds)
+        for name, seconds in self._run_timer.stages.items():
+            stage_seconds[name] = stage_seconds.get(name, 0.0) + seconds
+        parent_rss = peak_rss_mb()
+        return {
+            'event': 'run',
+            'script': self.script,
+            'run_id': self.run_id,
+            'wall_s': time.perf_counter() - self._start,
+            'cases': dict(self.status_counts),
+            'stages': stage_seconds,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'peak_rss_mb': max(filter(None, (self.peak_rss_mb, parent_rss)), default=None),
+        }
+
+    def prometheus_text(self, summary):
+        script = _escape_label(self.script)
+        lines = [
+            '# HELP segpipe_run_seconds Wall time of the last run.',
+            '# TYPE segpipe_run_seconds gauge',
+            f'segpipe_run_seconds{{script="{script}"}} {summary["wall_s"]}',
+            '# HELP segpipe_stage_seconds_total Wall time spent in each stage, summed over cases.',
+            '# TYPE segpipe_stage_seconds_total counter',
+        ]
+        lines += [f'segpipe_stage_seconds_total{{script="{script}",stage="{_escape_label(name)}"}} {seconds}'
+                  for name, seconds in sorted(summary['stages'].items())]
+        lines += [
+            '# HELP segpipe_cases_total Cases processed, by outcome.',
+            '# TYPE segpipe_cases_total counter',
+        ]
+        lines += [f'segpipe_cases_total{{script="{script}",status="{_escape_label(status)}"}} {count}'
+                  for status, count in sorted(summary['cases'].items())]
+        lines += [
+            '# HELP segpipe_bytes_read_total Bytes read from input files.',
+            '# TYPE segpipe_bytes_read_total counter',
+            f'segpipe_bytes_read_total{{script="{script}"}} {summary["bytes_read"]}',
+            '# HELP segpipe_bytes_written_total Bytes written to output files.',
+            '# TYPE segpipe_bytes_written_total counter',
+            f'segpipe_bytes_written_total{{script="{script}"}} {summary["bytes_written"]}',
+        ]
+        if summary['peak_rss_mb'] is not None:
+            lines += [
+                '# HELP segpipe_peak_rss_megabytes Largest peak RSS of any process in the run.',
+                '# TYPE segpipe_peak_rss_megabytes gauge',
+                f'segpipe_peak_rss_megabytes{{script="{script}"}} {summary["peak_rss_mb"]}',
+            ]
+        return '\n'.join(lines) + '\n'
+
+    def close(self):
+        if not self.enabled:
+            return None
+        summary = self.summary()
+        with self._lock:
+            if self._file is not None:
+                self._file.write(json.dumps(summary) + '\n')
+                self._file.close()
+                self._file = None
+        if self.prometheus_path:
+            tmp_path = f"{self.prometheus_path}.tmp"
+            with open(tmp_path, 'w') as f:
+                f.write(self.prometheus_text(summary))
+            os.replace(tmp_path, self.prometheus_path)
+        return summary
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
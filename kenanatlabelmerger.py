@@ -3,6 +3,9 @@ import os
 import numpy as np
 import glob
 import csv
+from concurrent.futures import ProcessPoolExecutor
+from label_store import open_label_store, read_sitk_labels
+from instrumentation import RunReport, CaseTimer, NULL_TIMER
 
 # head_segment_predictions are JCai's prediction labels (anatomy)
 # ich_segmentations are ground truth ischaemic infarct labels
@@ -17,9 +20,15 @@ log_file_path = os.path.join(
     "D:/Matlab Registration Code/NCCT_Anatomy20SeptInt/NCCT_Anatomy20SeptInt/Cropped/labelmerger/segmentation_log.csv",
 )
 
-# Ensure the output directory exists
-if not os.path.exists(output_folder):
-    os.makedirs(output_folder)
+# Number of case pairs merged in parallel
+max_workers = os.cpu_count()
+
+# Optional directory of chunked label stores (see label_store.py) read instead of the raw files; None reads the files
+label_store_dir = None
+
+# Per-pair stage timings as JSON lines and/or a Prometheus text file (see instrumentation.py); None disables them
+report_jsonl = None
+report_prometheus = None
 
 # Define the mapping from segment names to unique segment IDs for the first segmentation file
 segment_dict1 = {
@@ -75,33 +84,143 @@ semantic_dict = {
 #    "Segment_103": "Subarachnoid Haemorrhage",
 #    "Segment_104": "Acute Subdural Haemorrhage",
 
-# Open the CSV file to write the log
-with open(log_file_path, "w", newline="") as log_file:
-    log_writer = csv.writer(log_file)
-    # Write the header row
-    log_writer.writerow(
-        [
-            "HeadCT_Segmentation",
-            "ICH_Segmentation",
-            "Combined_Segmentation",
-            "HeadCT_Dimensions",
-            "HeadCT_Origin",
-            "ICH_Dimensions",
-            "ICH_Origin",
-            "Combined_Dimensions",
-            "Combined_Origin",
-        ]
-    )
+LOG_HEADER = [
+    "HeadCT_Segmentation",
+    "ICH_Segmentation",
+    "Combined_Segmentation",
+    "HeadCT_Dimensions",
+    "HeadCT_Origin",
+    "ICH_Dimensions",
+    "ICH_Origin",
+    "Combined_Dimensions",
+    "Combined_Origin",
+]
+
+
+# Helper function to get the root filename without extension
+def get_root_filename(filename):
+    base_name = os.path.basename(filename)
+    if base_name.endswith(".nii.gz"):
+        return base_name[:-7]  # Remove the .nii.gz extension correctly
+    elif base_name.endswith(".nrrd"):
+        return base_name[:-5]  # Remove the .nrrd extension
+    else:
+        return os.path.splitext(base_name)[0]  # General case
+
+
+# Convert {"Segment_<old>": new} into {old: new}
+def label_mapping(segment_dict):
+    return {int(old.split("_")[1]): new for old, new in segment_dict.items()}
+
+
+# Renumber labels through a lookup table in a single pass over the volume.
+# All rules apply simultaneously to the original values, so a voxel remapped to 11 is never hit by the rule for 11,
+# and the result does not depend on dict order. Labels without a rule are left unchanged.
+def remap_labels(arr, mapping):
+    if np.issubdtype(arr.dtype, np.integer):
+        values = arr
+    else:
+        values = arr.astype(np.int64)
+        if not np.array_equal(values, arr):
+            raise ValueError("Label map contains non-integer values")
+    lo = min(int(values.min()), min(mapping))
+    hi = max(int(values.max()), max(mapping))
+    lut = np.arange(lo, hi + 1, dtype=np.int64)
+    for old, new in mapping.items():
+        lut[old - lo] = new
+    lut = lut.astype(arr.dtype)
+    if lo == 0:
+        return lut[values]
+    return lut[values.astype(np.int64) - lo]
 
-    # Helper function to get the root filename without extension
-    def get_root_filename(filename):
-        base_name = os.path.basename(filename)
-        if base_name.endswith(".nii.gz"):
-            return base_name[:-7]  # Remove the .nii.gz extension correctly
-        elif base_name.endswith(".nrrd"):
-            return base_name[:-5]  # Remove the .nrrd extension
-        else:
-            return os.path.splitext(base_name)[0]  # General case
+
+# Map each root filename to its file, keeping the first match in sorted order like the previous linear scan
+def index_by_root_filename(filenames):
+    index = {}
+    for filename in filenames:
+        index.setdefault(get_root_filename(filename), filename)
+    return index
+
+
+# Load a segmentation as a NumPy array (z, y, x) plus its size and spatial information,
+# either from the file itself or from its label store
+def read_segmentation(filename, label_store_dir=None):
+    if label_store_dir is not None:
+        try:
+            store = open_label_store(filename, label_store_dir, read_sitk_labels)
+            return store.to_array(), dict(store.meta, size=tuple(reversed(store.shape)))
+        except ValueError:
+            # Maps the store cannot hold (non-integer values) are read from the file, as ConvertTo16Bit does
+            pass
+    seg = sitk.ReadImage(filename)
+    geometry = {
+        "size": seg.GetSize(),
+        "spacing": seg.GetSpacing(),
+        "origin": seg.GetOrigin(),
+        "direction": seg.GetDirection(),
+    }
+    return sitk.GetArrayFromImage(seg), geometry
+
+
+# Merge one head segmentation with its ICH segmentation and return the log row
+def merge_pair(head_segment_filename, ich_segment_filename, output_folder, label_store_dir=None, timer=NULL_TIMER):
+    head_filename_root = get_root_filename(head_segment_filename)
+
+    # Load the segmentation files as NumPy arrays
+    timer.read_file(head_segment_filename)
+    timer.read_file(ich_segment_filename)
+    with timer.stage("load"):
+        head_seg_array, head_geometry = read_segmentation(head_segment_filename, label_store_dir)
+        ich_seg_array, ich_geometry = read_segmentation(ich_segment_filename, label_store_dir)
+
+    with timer.stage("remap"):
+        # Perform the necessary segment merging and renumbering for the first segmentation file
+        head_seg_array = remap_labels(head_seg_array, label_mapping(segment_dict1))
+
+        # Perform the necessary segment merging and renumbering for the second segmentation file
+        ich_seg_array = remap_labels(ich_seg_array, label_mapping(segment_dict2))
+
+        # Combine the two segmentation arrays
+        combined_seg_array = np.maximum(head_seg_array, ich_seg_array)
+
+    # Save the combined segmentation as a new NRRD file
+    combined_seg = sitk.GetImageFromArray(combined_seg_array)
+    # Copy spatial information from the original image
+    combined_seg.SetSpacing(head_geometry["spacing"])
+    combined_seg.SetOrigin(head_geometry["origin"])
+    combined_seg.SetDirection(head_geometry["direction"])
+
+    # Save the combined segmentation as a new NRRD file
+    output_filename = os.path.join(output_folder, head_filename_root + ".nrrd")
+    with timer.stage("write"):
+        sitk.WriteImage(combined_seg, output_filename)
+    timer.wrote_file(output_filename)
+    print(output_filename, "saved")
+
+    return [
+        os.path.basename(head_segment_filename),
+        os.path.basename(ich_segment_filename),
+        os.path.basename(output_filename),
+        str(tuple(head_geometry["size"])),
+        str(tuple(head_geometry["origin"])),
+        str(tuple(ich_geometry["size"])),
+        str(tuple(ich_geometry["origin"])),
+        str(combined_seg.GetSize()),
+        str(combined_seg.GetOrigin()),
+    ]
+
+
+# Worker entry point for main(): merges one pair and returns (log row, timing record or None)
+def merge_pair_task(head_segment_filename, ich_segment_filename, output_folder, label_store_dir=None, instrument=False):
+    timer = CaseTimer(get_root_filename(head_segment_filename), enabled=instrument)
+    row = merge_pair(head_segment_filename, ich_segment_filename, output_folder, label_store_dir, timer)
+    return row, timer.finish()
+
+
+def main():
+    # Ensure the output directory exists
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
 
     # Get the list of segmentation files
     head_segment_filenames = sorted(
@@ -111,79 +230,44 @@ with open(log_file_path, "w", newline="") as log_file:
         glob.glob(os.path.join(ich_segmentations_folder, "*.nii.gz"))
         + glob.glob(os.path.join(ich_segmentations_folder, "*.nrrd"))
     )
+    ich_segment_index = index_by_root_filename(ich_segment_filenames)
 
-    # Loop over each pair of segmentation files
-    for head_segment_filename in head_segment_filenames:
-        head_filename_root = get_root_filename(head_segment_filename)
-        ich_segment_filename = next(
-            (
-                f
-                for f in ich_segment_filenames
-                if get_root_filename(f) == head_filename_root
-            ),
-            None,
-        )
-
-        if ich_segment_filename is None:
-            print(
-                f"Could not find matching ICH segmentation file for {head_filename_root}"
-            )
-            log_writer.writerow(
-                [
-                    os.path.basename(head_segment_filename),
-                    "NOT FOUND",
-                    "N/A",
-                    "N/A",
-                    "N/A",
-                    "N/A",
-                    "N/A",
-                    "N/A",
-                    "N/A",
-                ]
-            )
-            continue
-
-        # Load the segmentation files
-        head_seg = sitk.ReadImage(head_segment_filename)
-        ich_seg = sitk.ReadImage(ich_segment_filename)
-
-        # Convert to NumPy arrays
-        head_seg_array = sitk.GetArrayFromImage(head_seg)
-        ich_seg_array = sitk.GetArrayFromImage(ich_seg)
+    with RunReport("kenanatlabelmerger", report_jsonl, report_prometheus) as report:
+        # Open the CSV file to write the log
+        with open(log_file_path, "w", newline="") as log_file:
+            log_writer = csv.writer(log_file)
+            # Write the header row
+            log_writer.writerow(LOG_HEADER)
 
-        # Perform the necessary segment merging and renumbering for the first segmentation file
-        for old, new in segment_dict1.items():
-            head_seg_array[head_seg_array == int(old.split("_")[1])] = new
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                # Submit every pair first, then write the log rows in head segmentation order
+                pending = []
+                for head_segment_filename in head_segment_filenames:
+                    head_filename_root = get_root_filename(head_segment_filename)
+                    ich_segment_filename = ich_segment_index.get(head_filename_root)
+                    if ich_segment_filename is None:
+                        pending.append((head_segment_filename, None))
+                    else:
+                        future = executor.submit(
+                            merge_pair_task, head_segment_filename, ich_segment_filename, output_folder, label_store_dir, report.enabled
+                        )
+                        pending.append((head_segment_filename, future))
 
-        # Perform the necessary segment merging and renumbering for the second segmentation file
-        for old, new in segment_dict2.items():
-            ich_seg_array[ich_seg_array == int(old.split("_")[1])] = new
+                for head_segment_filename, future in pending:
+                    if future is None:
+                        print(
+                            f"Could not find matching ICH segmentation file for {get_root_filename(head_segment_filename)}"
+                        )
+                        log_writer.writerow(
+                            [os.path.basename(head_segment_filename), "NOT FOUND"] + ["N/A"] * 7
+                        )
+                        continue
 
-        # Combine the two segmentation arrays
-        combined_seg_array = np.maximum(head_seg_array, ich_seg_array)
+                    # Log the details
+                    row, record = future.result()
+                    log_writer.writerow(row)
+                    report.record(record)
 
-        # Save the combined segmentation as a new NRRD file
-        combined_seg = sitk.GetImageFromArray(combined_seg_array)
-        combined_seg.CopyInformation(
-            head_seg
-        )  # Copy spatial information from the original image
 
-        # Save the combined segmentation as a new NRRD file
-        output_filename = os.path.join(output_folder, head_filename_root + ".nrrd")
-        sitk.WriteImage(combined_seg, output_filename)
-        print(output_filename, "saved")
-
-        # Log the details
-        log_writer.writerow(
-            [
-                os.path.basename(head_segment_filename),
-                os.path.basename(ich_segment_filename),
-                os.path.basename(output_filename),
-                str(head_seg.GetSize()),
-                str(head_seg.GetOrigin()),
-                str(ich_seg.GetSize()),
-                str(ich_seg.GetOrigin()),
-                str(combined_seg.GetSize()),
-                str(combined_seg.GetOrigin()),
-            ]
-        )
\ No newline at end of file
+if __name__ == "__main__":
+    main()
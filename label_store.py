@@ -0,0 +1,212 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+from scipy import ndimage
+
+# Compact cache format for integer label maps.
+#
+# A store is a directory holding
+#   chunks.npy  the volume cut into fixed-size chunks (uncompressed, memory-mappable, smallest integer dtype),
+#               laid out as (n_chunks_0, n_chunks_1, n_chunks_2, *chunk_shape) so every chunk is contiguous on disk
+#   index.json  source fingerprint, geometry, the chunks that contain foreground (non-zero) voxels,
+#               and per-label voxel counts and bounding boxes
+#
+# Stores are built lazily the first time a source file is opened through open_label_store(), and rebuilt
+# when the source file's size or mtime no longer matches the fingerprint in the index.
+
+# Bumped whenever the index format or contents change, so stores built by older code are rebuilt
+STORE_VERSION = 2
+DEFAULT_CHUNK_SHAPE = (32, 32, 32)
+
+
+def read_nifti_labels(path):
+    # Label array in nibabel (x, y, z) order plus the header geometry the stats script needs
+    from volume_io import load_volume
+    data, header = load_volume(path, mmap=False)
+    zooms = header.get_zooms()
+    meta = {
+        'affine': header.get_best_affine().tolist(),
+        'zooms': [float(z) for z in zooms],
+        'zooms_dtype': np.asarray(zooms).dtype.str,
+    }
+    return np.asarray(data), meta
+
+
+def read_sitk_labels(path):
+    # Label array in SimpleITK (z, y, x) order plus the image geometry, for the merger
+    import SimpleITK as sitk
+    img = sitk.ReadImage(path)
+    meta = {
+        'spacing': list(img.GetSpacing()),
+        'origin': list(img.GetOrigin()),
+        'direction': list(img.GetDirection()),
+    }
+    return sitk.GetArrayFromImage(img), meta
+
+
+def source_fingerprint(path):
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def store_path_for(source_path, store_root, reader):
+    # One store per source file and reader (the readers use different axis orders)
+    digest = hashlib.sha1(f"{os.path.abspath(source_path)}|{reader.__name__}".encode()).hexdigest()[:12]
+    return os.path.join(store_root, f"{os.path.basename(source_path)}-{digest}.lblstore")
+
+
+def smallest_int_dtype(lo, hi):
+    return np.result_type(np.min_scalar_type(int(lo)), np.min_scalar_type(int(hi)))
+
+
+def build_label_store(source_path, store_path, reader=read_nifti_labels, chunk_shape=DEFAULT_CHUNK_SHAPE):
+    data, meta = reader(source_path)
+    if data.ndim != len(chunk_shape):
+        raise ValueError(f"{source_path}: expected a {len(chunk_shape)}D label map, got shape {data.shape}")
+    if np.issubdtype(data.dtype, np.integer):
+        values = data
+    else:
+        with np.errstate(invalid='ignore'):
+            values = data.astype(np.int64)
+        if not np.array_equal(values, data):
+            raise ValueError(f"{source_path}: label map contains non-integer values")
+    lo, hi = int(values.min()), int(values.max())
+    dtype = smallest_int_dtype(min(lo, 0), hi)
+
+    # Pad with background to whole chunks and reorder so each chunk is contiguous
+    n_chunks = [-(-n // c) for n, c in zip(data.shape, chunk_shape)]
+    padded = np.zeros([n * c for n, c in zip(n_chunks, chunk_shape)], dtype=dtype)
+    padded[tuple(slice(0, n) for n in data.shape)] = values
+    chunks = padded.reshape(n_chunks[0], chunk_shape[0], n_chunks[1], chunk_shape[1], n_chunks[2], chunk_shape[2])
+    chunks = np.ascontiguousarray(chunks.transpose(0, 2, 4, 1, 3, 5))
+    nonempty = np.argwhere(chunks.any(axis=(3, 4, 5)))
+
+    # Per-label voxel counts and bounding boxes (background 0 is not indexed)
+    # The offsets are taken in int64: in the source dtype label 255 + 1 would wrap to 0 for uint8 maps, and int16 maps
+    # with a negative minimum overflow the same way
+    labels = {}
+    offsets = values.astype(np.int64)
+    offsets -= lo
+    counts = np.bincount(offsets.ravel(), minlength=hi - lo + 1)
+    offsets += 1
+    boxes = ndimage.find_objects(offsets)
+    del offsets
+    for offset, box in enumerate(boxes):
+        label = offset + lo
+        if label == 0 or box is None:
+            continue
+        labels[str(label)] = {
+            'count': int(counts[offset]),
+            'bbox': [[s.start, s.stop] for s in box],
+        }
+
+    index = {
+        'version': STORE_VERSION,
+        'source': source_fingerprint(source_path),
+        'reader': reader.__name__,
+        'shape': list(data.shape),
+        'source_dtype': data.dtype.str,
+        'dtype': np.dtype(dtype).str,
+        'chunk_shape': list(chunk_shape),
+        'nonempty_chunks': nonempty.tolist(),
+        'labels': labels,
+        'meta': meta,
+    }
+
+    # Build in a temporary directory and rename it into place, so readers never see a half-written store
+    tmp_path = f"{store_path}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    np.save(os.path.join(tmp_path, 'chunks.npy'), chunks)
+    with open(os.path.join(tmp_path, 'index.json'), 'w') as f:
+        json.dump(index, f)
+    shutil.rmtree(store_path, ignore_errors=True)
+    try:
+        os.rename(tmp_path, store_path)
+    except OSError:
+        # Another process finished building the same store first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    return LabelStore(store_path)
+
+
+def open_label_store(source_path, store_root, reader=read_nifti_labels, chunk_shape=DEFAULT_CHUNK_SHAPE):
+    # Open the store for source_path, building or rebuilding it when missing or out of date
+    store_path = store_path_for(source_path, store_root, reader)
+    os.makedirs(store_root, exist_ok=True)
+    try:
+        store = LabelStore(store_path)
+        fingerprint = source_fingerprint(source_path)
+        if store.index['version'] == STORE_VERSION and all(store.index['source'][k] == fingerprint[k] for k in ('size', 'mtime_ns')):
+            return store
+    except (OSError, ValueError, KeyError):
+        pass
+    return build_label_store(source_path, store_path, reader, chunk_shape)
+
+
+class LabelStore:
+    def __init__(self, store_path):
+        self.path = store_path
+        with open(os.path.join(store_path, 'index.json')) as f:
+            self.index = json.load(f)
+        self.chunks = np.load(os.path.join(store_path, 'chunks.npy'), mmap_mode='r')
+        self.shape = tuple(self.index['shape'])
+        self.chunk_shape = tuple(self.index['chunk_shape'])
+        self.dtype = np.dtype(self.index['dtype'])
+        self.source_dtype = np.dtype(self.index['source_dtype'])
+        self.meta = self.index['meta']
+        self.labels = {int(label): entry for label, entry in self.index['labels'].items()}
+        self.nonempty_chunks = [tuple(c) for c in self.index['nonempty_chunks']]
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def zooms(self):
+        # Voxel sizes in the dtype the header stored them in, so derived volumes match the NIfTI path exactly
+        return tuple(np.asarray(self.meta['zooms'], dtype=self.meta.get('zooms_dtype', 'f8')))
+
+    def voxel_count(self, label):
+        entry = self.labels.get(int(label))
+        return entry['count'] if entry else 0
+
+    def bounding_box(self, labels, margin=0):
+        # Slices covering every voxel of the given labels (plus margin, clipped to the volume), or None if all are absent
+        boxes = [self.labels[int(label)]['bbox'] for label in labels if int(label) in self.labels]
+        if not boxes:
+            return None
+        return tuple(
+            slice(max(min(box[axis][0] for box in boxes) - margin, 0), min(max(box[axis][1] for box in boxes) + margin, n))
+            for axis, n in enumerate(self.shape)
+        )
+
+    def read_chunks(self, coords):
+        # Array of shape (len(coords), *chunk_shape); only the listed chunks are read from disk
+        if not coords:
+            return np.zeros((0,) + self.chunk_shape, dtype=self.dtype)
+        coords = np.asarray(coords)
+        return self.chunks[coords[:, 0], coords[:, 1], coords[:, 2]]
+
+    def read_region(self, region=None, dtype=None):
+        # Assemble the voxels inside `region` (a tuple of slices, default the whole volume) from the chunks it touches
+        if region is None:
+            region = tuple(slice(0, n) for n in self.shape)
+        starts = [s.start for s in region]
+        stops = [s.stop for s in region]
+        out = np.empty([b - a for a, b in zip(starts, stops)], dtype=dtype or self.dtype)
+        chunk_ranges = [range(a // c, -(-b // c)) for a, b, c in zip(starts, stops, self.chunk_shape)]
+        for i in chunk_ranges[0]:
+            for j in chunk_ranges[1]:
+                for k in chunk_ranges[2]:
+                    origin = (i * self.chunk_shape[0], j * self.chunk_shape[1], k * self.chunk_shape[2])
+                    lo = [max(a, o) for a, o in zip(starts, origin)]
+                    hi = [min(b, o + c) for b, o, c in zip(stops, origin, self.chunk_shape)]
+                    out[tuple(slice(l - a, h - a) for l, h, a in zip(lo, hi, starts))] = \
+                        self.chunks[i, j, k][tuple(slice(l - o, h - o) for l, h, o in zip(lo, hi, origin))]
+        return out
+
+    def to_array(self):
+        # The whole volume in the dtype of the source file
+        return self.read_region(dtype=self.source_dtype)
@@ -0,0 +1,113 @@
+import numpy as np
+from scipy import ndimage
+from surface_distance import joint_bounding_box
+
+try:
+    import cc3d  # connected-components-3d: much faster 3D labelling than scipy on large volumes
+except ImportError:
+    cc3d = None
+
+# Lesion-wise (connected-component) detection metrics between two binary masks.
+# Each mask is labelled once, components below the minimum volume are dropped, and all component overlaps come
+# from a single bincount over (GT component, predicted component) pairs, so the cost does not grow with the
+# number of lesions.
+#
+# A GT lesion is detected when any predicted component overlaps it; a predicted component that overlaps no GT
+# lesion is a false positive.
+
+# Neighbourhood used to join voxels into one lesion (6, 18 or 26)
+DEFAULT_CONNECTIVITY = 26
+
+# Labels evaluated lesion-wise by default: the ischaemic infarct, label 13 in the merged label maps (kenanatlabelmerger.py)
+DEFAULT_LESION_LABELS = (13,)
+
+LESION_CSV_HEADER = [
+    'Case', 'Segmentation Label', 'Lesion', 'Type', 'Detected', 'Voxel Count', 'Volume (cm^3)',
+    'Overlapping Component Volume (cm^3)', 'Overlap Volume (cm^3)', 'Volume Error (cm^3)', 'Lesion Dice',
+]
+
+
+def label_components(mask, connectivity=DEFAULT_CONNECTIVITY):
+    # (component labels, number of components); cc3d is used when installed, scipy.ndimage otherwise
+    mask = np.asarray(mask, dtype=bool)
+    if cc3d is not None and mask.ndim == 3:
+        labels = cc3d.connected_components(mask, connectivity=connectivity)
+        return labels, int(labels.max())
+    rank = {6: 1, 18: 2, 26: 3}[connectivity]
+    structure = ndimage.generate_binary_structure(mask.ndim, min(rank, mask.ndim))
+    return ndimage.label(mask, structure=structure)
+
+
+def remove_small_components(labels, n_components, min_voxels):
+    # Drops components smaller than min_voxels and renumbers the rest 1..n; returns (labels, n)
+    if min_voxels <= 1:
+        return labels, n_components
+    keep = np.bincount(labels.ravel(), minlength=n_components + 1) >= min_voxels
+    keep[0] = False
+    lut = np.zeros(n_components + 1, dtype=labels.dtype)
+    lut[keep] = np.arange(1, keep.sum() + 1, dtype=labels.dtype)
+    return lut[labels], int(keep.sum())
+
+
+def component_overlap(gt_labels, n_gt, pred_labels, n_pred):
+    # overlap[i, j] = voxels in GT component i and predicted component j (row/column 0 is background)
+    pairs = gt_labels.astype(np.intp) * (n_pred + 1) + pred_labels
+    return np.bincount(pairs.ravel(), minlength=(n_gt + 1) * (n_pred + 1)).reshape(n_gt + 1, n_pred + 1)
+
+
+def lesion_metrics(ground_truth, prediction, spacing, min_volume_mm3=0.0, connectivity=DEFAULT_CONNECTIVITY):
+    # Returns (summary dict, per-lesion rows). Rows are
+    #   [lesion id, 'GT' or 'FP', detected, voxel count, volume, overlapping predicted volume, overlap volume, volume error, lesion Dice]
+    # with volumes in cm^3; FP rows describe predicted components that touch no GT lesion.
+    ground_truth = np.asarray(ground_truth, dtype=bool)
+    prediction = np.asarray(prediction, dtype=bool)
+    voxel_mm3 = float(np.prod(spacing[:ground_truth.ndim]))
+    voxel_cm3 = voxel_mm3 / 1000
+    min_voxels = int(np.ceil(min_volume_mm3 / voxel_mm3)) if min_volume_mm3 > 0 else 1
+
+    # Every component lies inside the joint bounding box, so labelling can be limited to it
+    bbox = joint_bounding_box(ground_truth, prediction, margin=0)
+    if bbox is None:
+        overlap = np.zeros((1, 1), dtype=np.int64)
+        gt_counts = pred_counts = np.zeros(0, dtype=np.int64)
+    else:
+        gt_labels, n_gt = remove_small_components(*label_components(ground_truth[bbox], connectivity), min_voxels)
+        pred_labels, n_pred = remove_small_components(*label_components(prediction[bbox], connectivity), min_voxels)
+        overlap = component_overlap(gt_labels, n_gt, pred_labels, n_pred)
+        gt_counts = overlap[1:].sum(axis=1)
+        pred_counts = overlap[:, 1:].sum(axis=0)
+
+    lesion_overlap = overlap[1:, 1:]
+    touching = lesion_overlap > 0
+    detected = touching.any(axis=1)
+    true_components = touching.any(axis=0)
+
+    rows = []
+    for i, count in enumerate(gt_counts):
+        # Every predicted component touching the lesion counts towards its predicted volume
+        matched_count = pred_counts[touching[i]].sum()
+        inside = lesion_overlap[i].sum()
+        rows.append([
+            i + 1, 'GT', bool(detected[i]), int(count), count * voxel_cm3, matched_count * voxel_cm3,
+            inside * voxel_cm3, (matched_count - count) * voxel_cm3, 2 * inside / (count + matched_count),
+        ])
+    for j in np.flatnonzero(~true_components):
+        count = pred_counts[j]
+        rows.append([j + 1, 'FP', False, int(count), count * voxel_cm3, 0.0, 0.0, count * voxel_cm3, 0.0])
+
+    n_gt, n_pred = len(gt_counts), len(pred_counts)
+    n_detected = int(detected.sum())
+    n_true_components = int(true_components.sum())
+    sensitivity = n_detected / n_gt if n_gt else np.nan
+    precision = n_true_components / n_pred if n_pred else np.nan
+    summary = {
+        'gt_lesions': n_gt,
+        'predicted_lesions': n_pred,
+        'detected_lesions': n_detected,
+        'missed_lesions': n_gt - n_detected,
+        'false_positive_lesions': n_pred - n_true_components,
+        'lesion_sensitivity': sensitivity,
+        'lesion_precision': precision,
+        'lesion_f1': 2 * sensitivity * precision / (sensitivity + precision) if sensitivity + precision > 0 else np.nan,
+    }
+    return summary, rows
@@ -0,0 +1,137 @@
+import os
+import json
+import time
+import logging
+import argparse
+import tempfile
+import platform
+import numpy as np
+from requests.packages.urllib3.util.retry import Retry
+import batch_inference
+from benchmark_pipeline import make_phantom_pair, save_phantom, git_commit
+from mock_inference_server import start_server, ERROR_CODES
+
+# Load test for the batch_inference.py client: sends a set of phantom images at several concurrency levels and
+# reports throughput and p50/p95/p99 request latency. By default it runs against a local mock_inference_server with
+# the given latency and error rate, so retry/backoff and pooling settings can be tuned without any network.
+#
+#   python load_test_inference.py --concurrency 1 2 4 8 --latency 0.5 --error-rate 0.05
+#   python load_test_inference.py --url http://host:8003/infer/segmentation --concurrency 4
+
+
+def write_inputs(directory, n_files, size):
+    # CT-like int16 images (phantom regions at different intensities plus noise), so uploads compress like real scans
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(0)
+    for i in range(n_files):
+        labels, _ = make_phantom_pair((size, size, size), seed=i)
+        image = labels * 40.0 + rng.normal(0, 20, labels.shape)
+        save_phantom(image, os.path.join(directory, f"case{i:03d}.nii.gz"), 'int16')
+
+
+def server_requests(server):
+    return server.snapshot()['requests'] if server is not None else None
+
+
+def run_level(input_dir, output_root, concurrency, url):
+    # One batch at the given concurrency into a fresh output directory (so nothing comes from the inference cache)
+    output_dir = tempfile.mkdtemp(prefix=f"c{concurrency}_", dir=output_root)
+    n_files = len(os.listdir(input_dir))
+    upload_bytes = sum(os.path.getsize(os.path.join(input_dir, f)) for f in os.listdir(input_dir))
+    start = time.perf_counter()
+    latencies = batch_inference.run_batch(input_dir, output_dir, concurrency, url=url, force=True)
+    elapsed = time.perf_counter() - start
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if latencies else (np.nan,) * 3
+    return {
+        'concurrency': concurrency,
+        'files': n_files,
+        'succeeded': len(latencies),
+        'failed': n_files - len(latencies),
+        'wall_s': elapsed,
+        'files_per_s': len(latencies) / elapsed,
+        'upload_mb_per_s': upload_bytes / 1e6 / elapsed,
+        'latency_mean_s': float(np.mean(latencies)) if latencies else np.nan,
+        'latency_p50_s': float(p50),
+        'latency_p95_s': float(p95),
+        'latency_p99_s': float(p99),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test the batch inference client")
+    parser.add_argument('--url', help="inference endpoint to test (default: start a local mock server)")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--files', type=int, default=16, help="images sent per concurrency level")
+    parser.add_argument('--size', type=int, default=96, help="edge length of the phantom images")
+    parser.add_argument('--retries', type=int, default=batch_inference.retry_strategy.total)
+    parser.add_argument('--backoff', type=float, default=batch_inference.retry_strategy.backoff_factor)
+    parser.add_argument('--chunk-size', type=int, default=batch_inference.chunk_size)
+    mock = parser.add_argument_group('mock server')
+    mock.add_argument('--latency', type=float, default=0.2)
+    mock.add_argument('--jitter', type=float, default=0.1)
+    mock.add_argument('--latency-per-mb', type=float, default=0.0)
+    mock.add_argument('--error-rate', type=float, default=0.0)
+    mock.add_argument('--error-codes', type=int, nargs='+', default=ERROR_CODES)
+    mock.add_argument('--retry-after', type=int)
+    mock.add_argument('--payload', choices=['echo', 'synthetic'], default='echo')
+    mock.add_argument('--payload-size', type=int, default=64)
+    parser.add_argument('--output', help="write the results as JSON")
+    parser.add_argument('--verbose', action='store_true', help="keep the client's per-file log lines")
+    args = parser.parse_args(argv)
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    # The client reads these module settings when it builds each session
+    batch_inference.retry_strategy = Retry(
+        total=args.retries, backoff_factor=args.backoff,
+        status_forcelist=batch_inference.retry_strategy.status_forcelist, allowed_methods=["POST"],
+    )
+    batch_inference.chunk_size = args.chunk_size
+
+    server = None
+    url = args.url
+    if url is None:
+        server = start_server(
+            latency=args.latency, jitter=args.jitter, latency_per_mb=args.latency_per_mb, error_rate=args.error_rate,
+            error_codes=args.error_codes, retry_after=args.retry_after, payload=args.payload,
+            payload_size=args.payload_size, seed=0,
+        )
+        url = f"http://127.0.0.1:{server.server_port}/infer/segmentation"
+
+    results = []
+    try:
+        with tempfile.TemporaryDirectory(prefix='loadtest_') as root:
+            input_dir = os.path.join(root, 'input')
+            write_inputs(input_dir, args.files, args.size)
+            print(f"{'concurrency':>11s} {'ok':>4s} {'failed':>6s} {'wall s':>8s} {'files/s':>8s} {'MB/s up':>8s} "
+                  f"{'p50 s':>7s} {'p95 s':>7s} {'p99 s':>7s} {'requests':>8s}")
+            for concurrency in args.concurrency:
+                requests_before = server_requests(server)
+                result = run_level(input_dir, root, concurrency, url)
+                # Requests beyond one per file are client retries (only known for the local server)
+                result['server_requests'] = None if server is None else server_requests(server) - requests_before
+                results.append(result)
+                print(f"{concurrency:>11d} {result['succeeded']:>4d} {result['failed']:>6d} {result['wall_s']:>8.2f} "
+                      f"{result['files_per_s']:>8.2f} {result['upload_mb_per_s']:>8.1f} {result['latency_p50_s']:>7.3f} "
+                      f"{result['latency_p95_s']:>7.3f} {result['latency_p99_s']:>7.3f} {'' if result['server_requests'] is None else result['server_requests']:>8}")
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+    if args.output:
+        report = {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'git_commit': git_commit(),
+            'python': platform.python_version(),
+            'url': args.url or 'mock',
+            'settings': {key: value for key, value in vars(args).items() if key not in ('output', 'verbose')},
+            'results': results,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Load test results have been saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+import io
+import gzip
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import nibabel as nib
+from batch_inference import MultipartPartWriter, retry_strategy
+
+# Local stand-in for the segmentation inference server, for load-testing batch_inference.py without the GPU server.
+# It implements the same contract: POST /infer/<model> with a multipart/form-data upload (a 'model' field and the
+# image as an application/octet-stream part), answered with a multipart body holding a JSON params part and the
+# segmentation as an application/octet-stream part. GET /info/ reports a model version and GET /stats/ the counters.
+#
+#   python mock_inference_server.py --port 8003 --latency 0.5 --error-rate 0.05 --payload synthetic --payload-size 192
+
+# Status codes the client retries on, used for injected errors
+ERROR_CODES = list(retry_strategy.status_forcelist)
+
+
+def synthetic_segmentation(size):
+    # A gzipped uint8 NIfTI label map with size^3 voxels, built from the benchmark phantoms
+    from benchmark_pipeline import make_phantom_pair
+    labels, _ = make_phantom_pair((size, size, size))
+    return gzip.compress(nib.Nifti1Image(labels, np.eye(4)).to_bytes(), compresslevel=1)
+
+
+class MockInferenceServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, jitter=0.0, latency_per_mb=0.0, error_rate=0.0, error_codes=ERROR_CODES,
+                 retry_after=None, payload='echo', payload_size=64, model_version='mock-1', seed=None):
+        # latency + uniform(0, jitter) + latency_per_mb * upload size is slept before every answer.
+        # error_rate of the requests fail with a status drawn from error_codes (with a Retry-After header if set).
+        # payload 'echo' returns the uploaded image, 'synthetic' a payload_size^3 label map.
+        super().__init__(address, MockInferenceHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.latency_per_mb = latency_per_mb
+        self.error_rate = error_rate
+        self.error_codes = list(error_codes)
+        self.retry_after = retry_after
+        self.payload = payload
+        self.synthetic = synthetic_segmentation(payload_size) if payload == 'synthetic' else None
+        self.model_version = model_version
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'ok': 0, 'errors': {}, 'bytes_received': 0, 'bytes_sent': 0}
+
+    def count(self, key, value=1):
+        with self.lock:
+            self.stats[key] += value
+
+    def count_error(self, code):
+        with self.lock:
+            self.stats['errors'][str(code)] = self.stats['errors'].get(str(code), 0) + 1
+
+    def snapshot(self):
+        with self.lock:
+            return json.loads(json.dumps(self.stats))
+
+
+class MockInferenceHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload, headers=()):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        if self.path.rstrip('/') == '/info':
+            self.send_json(200, {'name': 'mock', 'version': server.model_version,
+                                 'models': {'segmentation': {'type': 'segmentation', 'version': server.model_version}}})
+        elif self.path.rstrip('/') == '/stats':
+            self.send_json(200, server.snapshot())
+        else:
+            self.send_json(404, {'detail': 'Not Found'})
+
+    def do_POST(self):
+        server = self.server
+        server.count('requests')
+        length = int(self.headers.get('Content-Length', 0))
+        # Read the upload in blocks, keeping only the image part
+        image = io.BytesIO()
+        parser = MultipartPartWriter(image)
+        remaining = length
+        while remaining > 0:
+            block = self.rfile.read(min(remaining, 1024 * 1024))
+            if not block:
+                break
+            parser.feed(block)
+            remaining -= len(block)
+        server.count('bytes_received', length)
+
+        if not self.path.startswith('/infer/'):
+            self.send_json(404, {'detail': 'Not Found'})
+            return
+        if not parser.found:
+            self.send_json(422, {'detail': 'No image in the upload'})
+            return
+
+        time.sleep(server.latency + server.random.uniform(0, server.jitter) + server.latency_per_mb * length / 1e6)
+        if server.error_codes and server.random.random() < server.error_rate:
+            code = server.random.choice(server.error_codes)
+            server.count_error(code)
+            headers = [('Retry-After', str(server.retry_after))] if server.retry_after is not None else []
+            self.send_json(code, {'detail': 'Injected error'}, headers)
+            return
+
+        segmentation = server.synthetic if server.payload == 'synthetic' else image.getvalue()
+        boundary = uuid.uuid4().hex
+        params = json.dumps({'label_names': {'background': 0}, 'latencies': {'infer': server.latency}})
+        head = (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="params"\r\nContent-Type: application/json\r\n\r\n{params}\r\n'
+            f'--{boundary}\r\nContent-Disposition: form-data; name="image"; filename="image.nii.gz"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n'
+        ).encode()
+        tail = f'\r\n--{boundary}--\r\n'.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', f'multipart/form-data; boundary={boundary}')
+        self.send_header('Content-Length', str(len(head) + len(segmentation) + len(tail)))
+        self.end_headers()
+        self.wfile.write(head)
+        self.wfile.write(segmentation)
+        self.wfile.write(tail)
+        server.count('ok')
+        server.count('bytes_sent', len(head) + len(segmentation) + len(tail))
+
+
+def start_server(host='127.0.0.1', port=0, **config):
+    # Runs a MockInferenceServer on a background thread; stop it with server.shutdown()
+    server = MockInferenceServer((host, port), **config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local stand-in for the segmentation inference server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8003)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds slept before every answer")
+    parser.add_argument('--jitter', type=float, default=0.0, help="extra uniformly distributed latency (seconds)")
+    parser.add_argument('--latency-per-mb', type=float, default=0.0, help="extra latency per MB uploaded (seconds)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of requests answered with an error")
+    parser.add_argument('--error-codes', type=int, nargs='+', default=ERROR_CODES)
+    parser.add_argument('--retry-after', type=int, help="Retry-After header (seconds) sent with errors")
+    parser.add_argument('--payload', choices=['echo', 'synthetic'], default='echo')
+    parser.add_argument('--payload-size', type=int, default=64, help="edge length of the synthetic label map")
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args(argv)
+
+    server = MockInferenceServer(
+        (args.host, args.port), latency=args.latency, jitter=args.jitter, latency_per_mb=args.latency_per_mb,
+        error_rate=args.error_rate, error_codes=args.error_codes, retry_after=args.retry_after,
+        payload=args.payload, payload_size=args.payload_size, seed=args.seed,
+    )
+    print(f"Mock inference server listening on http://{args.host}:{server.server_port}/infer/segmentation")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import os
+import json
+import glob
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+from concurrent.futures import ProcessPoolExecutor
+from result_cache import file_fingerprint
+
+# Python replacement for the "Resize" block of run_registration_batch (opt.do.vx, opt.vx.size = 1,
+# opt.bb.dim = [192 192 192]): resamples the coregistered reg_* images and label of every case onto one
+# 1 mm isotropic 192^3 grid and writes them as vx_reg_*, one output file per input and no pp_ intermediates.
+#
+# The grid of a case is derived from its reference image (the MR, as in the coregistration step): voxel axes follow
+# the reference orientation, and the grid is centred on the centre of the reference field of view. Grids are cached
+# per case, keyed on the reference file, so reruns and the other images of the case reuse them.
+# Images are interpolated linearly and labels with nearest neighbour; voxels outside the source image become 0.
+
+# Folder with the coregistered reg_* files (outputs are written next to them unless output_dir is set)
+data_dir = 'F:\\Registration Code\\NewTestingData\\Normals\\CTA'
+output_dir = None
+
+# File patterns of a case, paired by sorted order as in run_registration_batch; the first image is the reference
+image_patterns = ['reg_*_DWI_b1000.nii', 'reg_*_CTA.nii']
+label_patterns = ['reg_*_DWI.nii']
+
+# Target voxel size (mm) and grid dimensions
+voxel_size = 1.0
+grid_dim = (192, 192, 192)
+
+# Prefix of the output files (reg_x.nii -> vx_reg_x.nii)
+output_prefix = 'vx_'
+
+# Cached target grids (None: a .grid_cache folder in the output directory)
+grid_cache_dir = None
+
+# Number of cases resampled in parallel
+max_workers = os.cpu_count()
+
+
+def target_grid(reference_affine, reference_shape, voxel_size=voxel_size, grid_dim=grid_dim):
+    # Affine of a grid_dim grid with voxel_size voxels, in the orientation of the reference and centred on its field of view
+    axes = reference_affine[:3, :3] / np.linalg.norm(reference_affine[:3, :3], axis=0)
+    affine = np.eye(4)
+    affine[:3, :3] = axes * voxel_size
+    reference_centre = reference_affine @ np.append((np.asarray(reference_shape[:3]) - 1) / 2, 1)
+    affine[:3, 3] = reference_centre[:3] - affine[:3, :3] @ ((np.asarray(grid_dim) - 1) / 2)
+    return affine
+
+
+def cached_target_grid(reference_path, cache_dir, voxel_size=voxel_size, grid_dim=grid_dim):
+    # target_grid() of the reference, read from / stored in cache_dir
+    key = f"{file_fingerprint(reference_path)}|{voxel_size}|{tuple(grid_dim)}"
+    cache_path = os.path.join(cache_dir, os.path.basename(reference_path) + '.json')
+    try:
+        with open(cache_path) as f:
+            entry = json.load(f)
+        if entry['key'] == key:
+            return np.asarray(entry['affine'])
+    except (OSError, ValueError, KeyError):
+        pass
+
+    # Only the header is needed to place the grid
+    reference = nib.load(reference_path)
+    affine = target_grid(reference.affine, reference.shape, voxel_size, grid_dim)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({'key': key, 'affine': affine.tolist()}, f)
+    os.replace(tmp_path, cache_path)
+    return affine
+
+
+def resample_volume(data, source_affine, target_affine, shape=grid_dim, order=1):
+    # Resamples data (3D, or 4D volume by volume) from source_affine onto the target grid
+    matrix = np.linalg.inv(source_affine) @ target_affine
+    if data.ndim > 3:
+        return np.stack([resample_volume(data[..., t], source_affine, target_affine, shape, order) for t in range(data.shape[3])], axis=-1)
+    return ndimage.affine_transform(data, matrix[:3, :3], offset=matrix[:3, 3], output_shape=tuple(shape), order=order, mode='constant', cval=0)
+
+
+def resample_file(input_path, output_path, target_affine, is_label=False, grid_dim=grid_dim):
+    img = nib.load(input_path)
+    dtype = img.get_data_dtype()
+    if is_label:
+        # Nearest neighbour keeps the label values, so the labels are resampled in their stored dtype
+        data = np.asanyarray(img.dataobj)
+        resampled = resample_volume(data, img.affine, target_affine, grid_dim, order=0).astype(data.dtype)
+    else:
+        resampled = resample_volume(img.get_fdata(dtype=np.float32), img.affine, target_affine, grid_dim, order=1)
+        if np.issubdtype(dtype, np.integer):
+            # Integer images stay integer (rounded and clipped), as the MATLAB outputs do
+            info = np.iinfo(dtype)
+            resampled = np.clip(np.rint(resampled), info.min, info.max).astype(dtype)
+
+    out = nib.Nifti1Image(resampled, target_affine)
+    out.header.set_data_dtype(resampled.dtype)
+    out.header.set_xyzt_units(*img.header.get_xyzt_units())
+    out.set_qform(target_affine, code=int(img.header['qform_code']) or 1)
+    out.set_sform(target_affine, code=int(img.header['sform_code']) or 1)
+
+    # Written under a temporary name and renamed, so an interrupted run never leaves a truncated output
+    directory, name = os.path.split(output_path)
+    tmp_path = os.path.join(directory, f".tmp{os.getpid()}_{name}")
+    try:
+        nib.save(out, tmp_path)
+        os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return output_path
+
+
+def output_path_for(input_path, output_dir=None, prefix=output_prefix):
+    return os.path.join(output_dir or os.path.dirname(input_path), prefix + os.path.basename(input_path))
+
+
+# Resample all images and labels of one case onto the grid of its reference image (the first image)
+def resample_case(image_paths, label_paths, output_dir=None, cache_dir=None, voxel_size=voxel_size, grid_dim=grid_dim):
+    reference_path = image_paths[0]
+    cache_dir = cache_dir or os.path.join(output_dir or os.path.dirname(reference_path), '.grid_cache')
+    target_affine = cached_target_grid(reference_path, cache_dir, voxel_size, grid_dim)
+    outputs = []
+    for paths, is_label in ((image_paths, False), (label_paths, True)):
+        for path in paths:
+            outputs.append(resample_file(path, output_path_for(path, output_dir), target_affine, is_label, grid_dim))
+    return outputs
+
+
+def find_cases(data_dir, image_patterns=image_patterns, label_patterns=label_patterns):
+    # [(image paths, label paths)] per case, pairing the sorted files of each pattern by position
+    images = [sorted(glob.glob(os.path.join(data_dir, pattern))) for pattern in image_patterns]
+    labels = [sorted(glob.glob(os.path.join(data_dir, pattern))) for pattern in label_patterns]
+    counts = {len(files) for files in images + labels}
+    if len(counts) > 1:
+        raise ValueError(f"Number of files per pattern do not match: {[len(files) for files in images + labels]}")
+    return [(list(case_images), list(case_labels)) for case_images, case_labels in zip(zip(*images), zip(*labels))]
+
+
+def main(data_dir=data_dir, output_dir=output_dir, max_workers=max_workers):
+    cases = find_cases(data_dir)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(resample_case, images, labels, output_dir, grid_cache_dir, voxel_size, grid_dim) for images, labels in cases]
+        for (images, _), future in zip(cases, futures):
+            try:
+                outputs = future.result()
+                print(f"Resampled {len(outputs)} files for {os.path.basename(images[0])}")
+            except Exception as e:
+                print(f"Error resampling {os.path.basename(images[0])}: {e}")
+    print(f"Resampled {len(cases)} cases to {voxel_size} mm, {'x'.join(str(n) for n in grid_dim)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import os
+import io
+import csv
+import json
+import hashlib
+
+# Persistent per-case cache of CSV rows.
+# An entry is keyed on the case name, fingerprints of the files that produced it and a metric-set version,
+# so replacing either input or changing the metric code makes the old entry unreachable.
+
+# Bytes hashed from the start of each file by the quick fingerprint (covers the NIfTI header and the gzip header)
+FINGERPRINT_BYTES = 64 * 1024
+
+
+def file_fingerprint(path, content_hash=False):
+    # Quick fingerprint: size + mtime + hash of the leading bytes. content_hash=True hashes the whole file instead.
+    stat = os.stat(path)
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        if content_hash:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+            return f"sha256:{digest.hexdigest()}"
+        digest.update(f.read(FINGERPRINT_BYTES))
+    return f"{stat.st_size}:{stat.st_mtime_ns}:{digest.hexdigest()}"
+
+
+def case_cache_key(case, paths, version, content_hash=False):
+    # The case name is part of the key because cached rows carry it: two cases with identical files
+    # must not replay each other's rows
+    digest = hashlib.sha256(str(version).encode())
+    digest.update(b'\0' + str(case).encode())
+    for path in paths:
+        digest.update(b'\0' + file_fingerprint(path, content_hash).encode())
+    return digest.hexdigest()
+
+
+def format_rows(rows):
+    # Cells exactly as csv.writer would write them, so cached rows replay byte-for-byte
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    return list(csv.reader(buffer))
+
+
+def _entry_path(cache_dir, key):
+    return os.path.join(cache_dir, key[:2], f"{key}.json")
+
+
+def load_cached_rows(cache_dir, key):
+    try:
+        with open(_entry_path(cache_dir, key)) as f:
+            return json.load(f)['rows']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def store_cached_rows(cache_dir, key, rows):
+    path = _entry_path(cache_dir, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write to a temporary file first so a crash never leaves a truncated entry behind
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({'rows': format_rows(rows)}, f)
+    os.replace(tmp_path, path)
@@ -0,0 +1,201 @@
+import os
+import csv
+import glob
+import time
+import numpy as np
+import SimpleITK as sitk
+from concurrent.futures import ProcessPoolExecutor
+from volume_io import load_volume, peak_rss_mb
+from instrumentation import RunReport, CaseTimer
+from kenanatlabelmerger import get_root_filename, index_by_root_filename, read_segmentation, remap_labels, label_mapping, segment_dict1, segment_dict2
+from ConvertTo16Bit import slab_to_int16
+from lesion_metrics import LESION_CSV_HEADER, DEFAULT_LESION_LABELS
+from segmentation_stats_with_flatten_function_parallelised_v2 import (
+    CSV_HEADER, case_rows, submit_bounded, format_eta, reorder_csv,
+)
+
+# Merge -> int16 -> stats in one pass per case, without the intermediate files of the stage-by-stage run
+# (kenanatlabelmerger.py writes NRRD, ConvertTo16Bit.py rewrites it as int16, the stats script reads it back).
+# Each worker runs its cases through a chain of generators, one stage per generator, handing the label arrays from
+# stage to stage in memory; only one case per stage is alive at a time. The merged int16 ground truth is written to
+# disk only when spill_dir is set.
+#
+# The rows match the stats script run on the converted merger outputs: arrays are transposed from SimpleITK's
+# (z, y, x) to nibabel's (x, y, z) order, and spacings are rounded to float32 as they are in a NIfTI header.
+
+# Input folders (as in kenanatlabelmerger.py) and the folder of predictions named <root>.nii.gz
+head_segment_predictions_folder = "D:/Matlab Registration Code/NCCT_Anatomy20SeptInt/NCCT_Anatomy20SeptInt/Cropped/labelmerger/UnmergedAnat"
+ich_segmentations_folder = "D:/Matlab Registration Code/NCCT_Anatomy20SeptInt/NCCT_Anatomy20SeptInt/Cropped/labelmerger/Ischemic"
+inference_dir = "D:/Matlab Registration Code/NCCT_Anatomy20SeptInt/NCCT_Anatomy20SeptInt/Cropped/labelmerger/Predictions"
+output_csv = "D:/Matlab Registration Code/NCCT_Anatomy20SeptInt/NCCT_Anatomy20SeptInt/Cropped/labelmerger/pipeline_stats.csv"
+
+# Optional folder for the merged int16 ground truth (<root>.nii.gz); None keeps it in memory only
+spill_dir = None
+
+# Number of workers, and cases handed to a worker at a time
+max_workers = os.cpu_count()
+cases_per_task = 1
+
+# Optional directory of chunked label stores (see label_store.py) read instead of the raw merger inputs
+label_store_dir = None
+
+# Optional lesion-wise CSV for lesion_labels (see lesion_metrics.py); None skips the lesion metrics
+lesion_csv = None
+lesion_labels = DEFAULT_LESION_LABELS
+min_lesion_volume_mm3 = 0.0
+
+# Per-case stage timings as JSON lines and/or a Prometheus text file (see instrumentation.py); None disables them
+report_jsonl = None
+report_prometheus = None
+
+
+# Stage 1: merge each (case, head file, ICH file) into one label array, as merge_pair does.
+# Yields (case, timer, merged (z, y, x) array, head geometry); a case that fails is passed on with a None array,
+# so the later stages skip it and stats_stage reports it as an error
+def merge_stage(cases, label_store_dir=None):
+    for case, timer, head_segment_filename, ich_segment_filename in cases:
+        try:
+            timer.read_file(head_segment_filename)
+            timer.read_file(ich_segment_filename)
+            with timer.stage('load'):
+                head_seg_array, head_geometry = read_segmentation(head_segment_filename, label_store_dir)
+                ich_seg_array, _ = read_segmentation(ich_segment_filename, label_store_dir)
+            with timer.stage('remap'):
+                combined_seg_array = np.maximum(
+                    remap_labels(head_seg_array, label_mapping(segment_dict1)),
+                    remap_labels(ich_seg_array, label_mapping(segment_dict2)),
+                )
+            del head_seg_array, ich_seg_array
+        except Exception as e:
+            print(f"Error merging {case}: {e}")
+            yield case, timer, None, None
+            continue
+        yield case, timer, combined_seg_array, head_geometry
+
+
+# Stage 2: convert to int16 with the clipping rules of ConvertTo16Bit.py, optionally spilling the result to spill_dir
+def int16_stage(items, spill_dir=None):
+    for case, timer, array, geometry in items:
+        if array is None:
+            yield case, timer, array, geometry
+            continue
+        try:
+            with timer.stage('convert'):
+                array, n_below, n_above, n_nan = slab_to_int16(array)
+            if n_below or n_above or n_nan:
+                print(f"{case}: {n_below} voxels clipped below, {n_above} clipped above, {n_nan} NaN set to 0")
+            if spill_dir is not None:
+                image = sitk.GetImageFromArray(array)
+                image.SetSpacing(geometry['spacing'])
+                image.SetOrigin(geometry['origin'])
+                image.SetDirection(geometry['direction'])
+                spill_path = os.path.join(spill_dir, case + '.nii.gz')
+                with timer.stage('write'):
+                    sitk.WriteImage(image, spill_path)
+                timer.wrote_file(spill_path)
+        except Exception as e:
+            print(f"Error converting {case}: {e}")
+            array = geometry = None
+        yield case, timer, array, geometry
+
+
+# Stage 3: metrics against the prediction, as process_file computes them. Yields the outcome dict of process_file
+def stats_stage(items, inference_dir, lesion_labels=(), min_lesion_volume_mm3=0.0):
+    for case, timer, array, geometry in items:
+        # The stats script names cases by the GT file name without its last extension ('<root>.nii')
+        base_name = case + '.nii'
+        pred_path = os.path.join(inference_dir, case + '.nii.gz')
+        results = []
+        lesion_results = []
+        status = 'missing prediction'
+        if array is None:
+            # Failed in an earlier stage, which printed the error
+            status = 'error'
+        elif os.path.exists(pred_path):
+            try:
+                timer.read_file(pred_path)
+                with timer.stage('load'):
+                    pred_data, _ = load_volume(pred_path)
+                ground_truth = array.transpose()
+                if ground_truth.shape != pred_data.shape:
+                    raise ValueError(f"Shapes differ: merged {ground_truth.shape}, prediction {pred_data.shape}")
+                zooms = tuple(np.float32(spacing) for spacing in geometry['spacing'])
+                results, lesion_results = case_rows(base_name, ground_truth, pred_data, zooms, lesion_labels, min_lesion_volume_mm3, timer)
+                status = 'ok'
+            except Exception as e:
+                print(f"Error processing {case}: {e}")
+                results = []
+                lesion_results = []
+                status = 'error'
+        else:
+            print(f"No prediction found for {case} at {pred_path}")
+        timer.set(labels=len(results), lesions=len(lesion_results))
+        yield {'case': case, 'rows': results, 'lesion_rows': lesion_results, 'peak_rss_mb': peak_rss_mb(), 'report': timer.finish(status)}
+
+
+# Worker entry point: runs a batch of (head file, ICH file) pairs through the stage chain and returns their outcomes
+def run_cases(pairs, inference_dir, spill_dir=None, label_store_dir=None, lesion_labels=(), min_lesion_volume_mm3=0.0, instrument=False):
+    # Lazy, so each case's timer starts when the chain pulls that case
+    cases = ((get_root_filename(head), CaseTimer(get_root_filename(head), enabled=instrument), head, ich) for head, ich in pairs)
+    chain = stats_stage(int16_stage(merge_stage(cases, label_store_dir), spill_dir), inference_dir, lesion_labels, min_lesion_volume_mm3)
+    return list(chain)
+
+
+def main(head_segment_predictions_folder=head_segment_predictions_folder, ich_segmentations_folder=ich_segmentations_folder,
+         inference_dir=inference_dir, output_csv=output_csv, spill_dir=spill_dir, max_workers=max_workers, cases_per_task=cases_per_task,
+         label_store_dir=label_store_dir, lesion_csv=lesion_csv, lesion_labels=lesion_labels, min_lesion_volume_mm3=min_lesion_volume_mm3,
+         report_jsonl=report_jsonl, report_prometheus=report_prometheus):
+    if spill_dir is not None:
+        os.makedirs(spill_dir, exist_ok=True)
+    head_segment_filenames = sorted(glob.glob(os.path.join(head_segment_predictions_folder, "*.nii.gz")))
+    ich_segment_index = index_by_root_filename(sorted(
+        glob.glob(os.path.join(ich_segmentations_folder, "*.nii.gz"))
+        + glob.glob(os.path.join(ich_segmentations_folder, "*.nrrd"))
+    ))
+    pairs = []
+    for head_segment_filename in head_segment_filenames:
+        ich_segment_filename = ich_segment_index.get(get_root_filename(head_segment_filename))
+        if ich_segment_filename is None:
+            print(f"Could not find matching ICH segmentation file for {get_root_filename(head_segment_filename)}")
+        else:
+            pairs.append((head_segment_filename, ich_segment_filename))
+    batches = [pairs[i:i + cases_per_task] for i in range(0, len(pairs), cases_per_task)]
+    lesion_labels = tuple(lesion_labels) if lesion_csv else ()
+
+    with RunReport('run_pipeline', report_jsonl, report_prometheus) as report:
+        max_workers = max_workers or os.cpu_count()
+        processed = 0
+        worker_peak_rss = []
+        start = time.perf_counter()
+        with open(output_csv, mode='w', newline='') as file, open(lesion_csv or os.devnull, mode='w', newline='') as lesion_file:
+            writer = csv.writer(file)
+            writer.writerow(CSV_HEADER)
+            lesion_writer = csv.writer(lesion_file)
+            lesion_writer.writerow(LESION_CSV_HEADER)
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                tasks = ((batch, inference_dir, spill_dir, label_store_dir, lesion_labels, min_lesion_volume_mm3, report.enabled) for batch in batches)
+                for _, future in submit_bounded(executor, run_cases, tasks, 2 * max_workers):
+                    for outcome in future.result():
+                        with report.stage('write'):
+                            writer.writerows(outcome['rows'])
+                            lesion_writer.writerows(outcome['lesion_rows'])
+                        report.record(outcome['report'])
+                        if outcome['peak_rss_mb'] is not None:
+                            worker_peak_rss.append(outcome['peak_rss_mb'])
+                        processed += 1
+                        rate = processed / (time.perf_counter() - start)
+                        print(f"Processed {processed}/{len(pairs)} cases ({outcome['case']}, {rate:.2f} cases/s, ETA {format_eta((len(pairs) - processed) / rate)})")
+
+        # Cases in input order, as the stats script writes them
+        with report.stage('write'):
+            case_order = {get_root_filename(head) + '.nii': i for i, (head, _) in enumerate(pairs)}
+            reorder_csv(output_csv, case_order)
+            if lesion_csv:
+                reorder_csv(lesion_csv, case_order)
+        if worker_peak_rss:
+            print(f"Peak worker RSS: {max(worker_peak_rss):.0f} MB")
+    print(f"Pipeline results for {processed} cases saved to {output_csv}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,25 @@
 import os
 import csv
+import time
 import numpy as np
-import nibabel as nib
 from sklearn.metrics import mean_absolute_error
-from scipy.spatial.distance import directed_hausdorff
-from concurrent.futures import ProcessPoolExecutor
+from surface_distance import calculate_surface_distances
+from volume_io import load_volume, peak_rss_mb
+from result_cache import case_cache_key, load_cached_rows, store_cached_rows
+from label_store import open_label_store
+from lesion_metrics import lesion_metrics, LESION_CSV_HEADER, DEFAULT_LESION_LABELS
+from instrumentation import RunReport, CaseTimer, NULL_TIMER
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from numba import jit
 
-@jit(nopython=True)
+# Optional lesion-wise CSV (see lesion_metrics.py) for lesion_labels; components under min_lesion_volume_mm3 are ignored.
+# None skips the lesion metrics.
+lesion_csv = None
+lesion_labels = DEFAULT_LESION_LABELS
+min_lesion_volume_mm3 = 0.0
+
+# cache=True keeps the compiled kernel on disk, so new processes load it instead of re-compiling
+@jit(nopython=True, cache=True)
 def calculate_iou_dice_pixel_accuracy(ground_truth_flat, prediction_flat):
     intersection = np.logical_and(ground_truth_flat, prediction_flat)
     union = np.logical_or(ground_truth_flat, prediction_flat)
@@ -19,15 +31,9 @@ def calculate_iou_dice_pixel_accuracy(ground_truth_flat, prediction_flat):
     
     return iou, dice, pixel_accuracy
 
-def calculate_hausdorff_3d(ground_truth, prediction):
-    max_distance = 0
-    for i in range(ground_truth.shape[0]):
-        gt_slice = ground_truth[i, :, :]
-        pred_slice = prediction[i, :, :]
-        distance = max(directed_hausdorff(gt_slice, pred_slice)[0], directed_hausdorff(pred_slice, gt_slice)[0])
-        if distance > max_distance:
-            max_distance = distance
-    return max_distance
+def calculate_hausdorff_3d(ground_truth, prediction, spacing=None):
+    # Symmetric 3D Hausdorff distance between the mask surfaces, in mm when spacing is the voxel size
+    return calculate_surface_distances(ground_truth, prediction, spacing)[0]
 
 def calculate_precision_recall_f1(ground_truth, prediction):
     true_positive = np.sum((ground_truth == 1) & (prediction == 1))
@@ -40,7 +46,7 @@ def calculate_precision_recall_f1(ground_truth, prediction):
     
     return precision, recall, f1
 
-def calculate_metrics(ground_truth, prediction):
+def calculate_metrics(ground_truth, prediction, spacing=None):
     ground_truth_flat = ground_truth.flatten()
     prediction_flat = prediction.flatten()
     
@@ -50,91 +56,371 @@ def calculate_metrics(ground_truth, prediction):
     
     mae = mean_absolute_error(ground_truth_flat, prediction_flat)
     
-    hausdorff_distance = calculate_hausdorff_3d(ground_truth, prediction)
+    hausdorff_distance, hausdorff_95, assd = calculate_surface_distances(ground_truth, prediction, spacing)
     
-    return iou, dice, pixel_accuracy, precision, recall, f1, mae, hausdorff_distance
+    return iou, dice, pixel_accuracy, precision, recall, f1, mae, hausdorff_distance, hausdorff_95, assd
+
+# Labels that are merged into a single region and reported alongside the per-label rows
+MERGED_LABEL_GROUPS = {
+    'combined_1_2': (1, 2),
+}
+
+# Widest label range (max - min + 1) counted in a dense range x range table by joint_label_histogram
+MAX_DENSE_LABEL_RANGE = 4096
+
+def joint_label_histogram(ground_truth, prediction):
+    # One pass over both volumes: table[i, j] counts voxels with GT label labels[i] and predicted label labels[j]
+    gt_flat = np.ravel(ground_truth)
+    pred_flat = np.ravel(prediction)
+    gt_int = gt_flat.astype(np.int64)
+    pred_int = pred_flat.astype(np.int64)
+    integral = np.issubdtype(gt_flat.dtype, np.integer) and np.issubdtype(pred_flat.dtype, np.integer)
+
+    if integral or (np.array_equal(gt_int, gt_flat) and np.array_equal(pred_int, pred_flat)):
+        lo = min(gt_int.min(), pred_int.min())
+        hi = max(gt_int.max(), pred_int.max())
+        n_bins = int(hi - lo) + 1
+    else:
+        n_bins = None
+
+    # A dense table over the whole label range, unless the range is so sparse that the table would not fit in memory
+    if n_bins is not None and n_bins <= MAX_DENSE_LABEL_RANGE:
+        # Build the bin index in place to keep the number of full-volume temporaries down
+        gt_int -= lo
+        gt_int *= n_bins
+        pred_int -= lo
+        gt_int += pred_int
+        counts = np.bincount(gt_int, minlength=n_bins * n_bins).reshape(n_bins, n_bins)
+        present = (counts.sum(axis=1) > 0) | (counts.sum(axis=0) > 0)
+        # In a dtype that holds the labels of both volumes (e.g. int16 prediction labels next to a uint8 GT)
+        labels = np.arange(lo, hi + 1)[present].astype(np.result_type(gt_flat.dtype, pred_flat.dtype))
+        return labels, counts[np.ix_(present, present)]
+
+    # Non-integral or widely spread label values: fall back to an explicit value -> bin mapping
+    labels, inverse = np.unique(np.concatenate([gt_flat, pred_flat]), return_inverse=True)
+    n_bins = len(labels)
+    gt_bins = inverse[:gt_flat.size]
+    pred_bins = inverse[gt_flat.size:]
+    counts = np.bincount(gt_bins * n_bins + pred_bins, minlength=n_bins * n_bins).reshape(n_bins, n_bins)
+    return labels, counts
+
+def calculate_metrics_from_counts(true_positive, false_positive, false_negative, total):
+    # Same formulas as calculate_metrics, evaluated on confusion counts instead of voxel masks
+    true_positive, false_positive, false_negative, total = int(true_positive), int(false_positive), int(false_negative), int(total)
+    gt_count = true_positive + false_negative
+    pred_count = true_positive + false_positive
+    true_negative = total - true_positive - false_positive - false_negative
+
+    iou = true_positive / (true_positive + false_positive + false_negative)
+    dice = 2 * true_positive / (gt_count + pred_count)
+    pixel_accuracy = (true_positive + true_negative) / total
+
+    precision = np.float64(true_positive) / pred_count if pred_count > 0 else 0
+    recall = np.float64(true_positive) / gt_count if gt_count > 0 else 0
+    f1 = 2 * (precision * recall) / (precision + recall) if (precision + recall) > 0 else 0
+
+    mae = (false_positive + false_negative) / total
 
-def calculate_metrics_per_segmentation(ground_truth, prediction, gt_path):
-    unique_labels = np.unique(ground_truth)
+    return iou, dice, pixel_accuracy, precision, recall, f1, mae
+
+def joint_label_histogram_from_stores(gt_store, pred_store):
+    # Same table as joint_label_histogram, but only chunks holding foreground in either volume are read;
+    # every other voxel is known to be background in both
+    if gt_store.shape != pred_store.shape or gt_store.chunk_shape != pred_store.chunk_shape:
+        raise ValueError(f"Label stores differ in shape: {gt_store.shape} vs {pred_store.shape}")
+    coords = sorted(set(gt_store.nonempty_chunks) | set(pred_store.nonempty_chunks))
+    if not coords:
+        return np.zeros(1, dtype=gt_store.dtype), np.array([[gt_store.size]])
+    labels, counts = joint_label_histogram(gt_store.read_chunks(coords), pred_store.read_chunks(coords))
+
+    # Voxels outside the chunks read, less the padding inside them, are (0, 0) background
+    background = gt_store.size - len(coords) * int(np.prod(gt_store.chunk_shape))
+    if background:
+        zero = int(np.searchsorted(labels, 0))
+        if zero == len(labels) or labels[zero] != 0:
+            labels = np.insert(labels, zero, 0)
+            counts = np.insert(np.insert(counts, zero, 0, axis=0), zero, 0, axis=1)
+        counts[zero, zero] += background
+    return labels, counts
+
+def metrics_from_confusion(labels, confusion, total, zooms, region_masks, timer=NULL_TIMER):
+    # Per-label and merged-group metrics from one joint label histogram.
+    # region_masks(label_values) returns (gt_mask, pred_mask) covering those labels, used for the surface distances.
+    gt_counts = confusion.sum(axis=1)
+    pred_counts = confusion.sum(axis=0)
     metrics_per_segmentation = {}
-    
-    for label in unique_labels:
-        if label == 0:
+
+    # Calculate voxel spacing and voxel size once per file
+    spacing = zooms[:3]
+    voxel_size = np.prod(zooms) / 1000
+
+    def region_metrics(group, index):
+        true_positive = confusion[np.ix_(index, index)].sum()
+        gt_voxel_count = gt_counts[index].sum()
+        pred_voxel_count = pred_counts[index].sum()
+        metrics = calculate_metrics_from_counts(true_positive, pred_voxel_count - true_positive, gt_voxel_count - true_positive, total)
+        with timer.stage('region_masks'):
+            masks = region_masks(group)
+        with timer.stage('surface_distance'):
+            surface_distances = calculate_surface_distances(*masks, spacing)
+        gt_segment_volume = voxel_size * gt_voxel_count
+        pred_segment_volume = voxel_size * pred_voxel_count
+        return metrics + surface_distances + (gt_voxel_count, pred_voxel_count, voxel_size, gt_segment_volume, pred_segment_volume)
+
+    for i, label in enumerate(labels):
+        if label == 0 or gt_counts[i] == 0:
             continue
-        gt_segmentation = (ground_truth == label).astype(int)
-        pred_segmentation = (prediction == label).astype(int)
-        
         try:
-            metrics = calculate_metrics(gt_segmentation, pred_segmentation)
-            gt_voxel_count = np.count_nonzero(gt_segmentation)
-            pred_voxel_count = np.count_nonzero(pred_segmentation)
-            
-            # Calculate voxel size and segment volume
-            voxel_size = np.prod(nib.load(gt_path).header.get_zooms()) / 1000
-            gt_segment_volume = voxel_size * gt_voxel_count
-            pred_segment_volume = voxel_size * pred_voxel_count
-            
-            metrics_per_segmentation[label] = metrics + (gt_voxel_count, pred_voxel_count, voxel_size, gt_segment_volume, pred_segment_volume)
+            metrics_per_segmentation[label] = region_metrics([label], [i])
             print(f"Processed label {label} for file")
         except Exception as e:
             print(f"Skipping label {label} due to error: {e}")
             continue
-    
-    combined_gt = np.logical_or(ground_truth == 1, ground_truth == 2).astype(int)
-    combined_pred = np.logical_or(prediction == 1, prediction == 2).astype(int)
-    
-    combined_metrics = calculate_metrics(combined_gt, combined_pred)
-    combined_gt_voxel_count = np.count_nonzero(combined_gt)
-    combined_pred_voxel_count = np.count_nonzero(combined_pred)
-    
-    # Calculate voxel size and segment volume for combined segments
-    voxel_size = np.prod(nib.load(gt_path).header.get_zooms()) / 1000
-    combined_gt_segment_volume = voxel_size * combined_gt_voxel_count
-    combined_pred_segment_volume = voxel_size * combined_pred_voxel_count
-    
-    metrics_per_segmentation['combined_1_2'] = combined_metrics + (combined_gt_voxel_count, combined_pred_voxel_count, voxel_size, combined_gt_segment_volume, combined_pred_segment_volume)
-    
+
+    for name, group in MERGED_LABEL_GROUPS.items():
+        index = [i for i, label in enumerate(labels) if label in group]
+        metrics_per_segmentation[name] = region_metrics(group, index)
+
     return metrics_per_segmentation
 
-def process_file(gt_file, ground_truth_dir, inference_dir):
+def array_region_masks(ground_truth, prediction):
+    # region_masks for whole label arrays
+    def region_masks(group):
+        return np.isin(ground_truth, group), np.isin(prediction, group)
+    return region_masks
+
+def store_region_masks(gt_store, pred_store):
+    # region_masks for label stores: only the joint bounding box of the group (plus a background margin) is read
+    def region_masks(group):
+        boxes = [box for box in (gt_store.bounding_box(group, margin=1), pred_store.bounding_box(group, margin=1)) if box is not None]
+        if not boxes:
+            empty = np.zeros((0,) * len(gt_store.shape), dtype=bool)
+            return empty, empty
+        region = tuple(slice(min(box[axis].start for box in boxes), max(box[axis].stop for box in boxes)) for axis in range(len(gt_store.shape)))
+        return np.isin(gt_store.read_region(region), group), np.isin(pred_store.read_region(region), group)
+    return region_masks
+
+def calculate_metrics_per_segmentation(ground_truth, prediction, gt_header, timer=NULL_TIMER):
+    with timer.stage('histogram'):
+        labels, confusion = joint_label_histogram(ground_truth, prediction)
+    return metrics_from_confusion(labels, confusion, ground_truth.size, gt_header.get_zooms(), array_region_masks(ground_truth, prediction), timer)
+
+def calculate_metrics_per_segmentation_from_stores(gt_store, pred_store, timer=NULL_TIMER):
+    # Same results as calculate_metrics_per_segmentation, reading label stores instead of whole volumes
+    with timer.stage('histogram'):
+        labels, confusion = joint_label_histogram_from_stores(gt_store, pred_store)
+    return metrics_from_confusion(labels, confusion, gt_store.size, gt_store.zooms, store_region_masks(gt_store, pred_store), timer)
+
+def calculate_lesion_metrics_per_segmentation(region_masks, zooms, lesion_labels, min_volume_mm3=0.0, timer=NULL_TIMER):
+    # Lesion-wise detection metrics for each requested label (or MERGED_LABEL_GROUPS name): {label: (summary, lesion rows)}
+    lesion_metrics_per_segmentation = {}
+    for label in lesion_labels:
+        group = MERGED_LABEL_GROUPS.get(label, (label,))
+        with timer.stage('region_masks'):
+            masks = region_masks(group)
+        with timer.stage('lesions'):
+            lesion_metrics_per_segmentation[label] = lesion_metrics(*masks, zooms[:3], min_volume_mm3)
+    return lesion_metrics_per_segmentation
+
+def rows_from_metrics(base_name, metrics_per_segmentation, region_masks, zooms, lesion_labels=(), min_lesion_volume_mm3=0.0, timer=NULL_TIMER):
+    # CSV rows and lesion CSV rows of one case from its per-label metrics
+    results = []
+    lesion_results = []
+    for label, metrics in metrics_per_segmentation.items():
+        # Labels are written as floats, as they were when volumes were loaded with get_fdata()
+        results.append([base_name, label if isinstance(label, str) else float(label)] + list(metrics))
+
+    if lesion_labels:
+        lesion_metrics_per_segmentation = calculate_lesion_metrics_per_segmentation(region_masks, zooms, lesion_labels, min_lesion_volume_mm3, timer)
+        for label, (summary, lesion_rows) in lesion_metrics_per_segmentation.items():
+            print(f"Label {label}: {summary['detected_lesions']}/{summary['gt_lesions']} lesions detected, {summary['false_positive_lesions']} false positive")
+            lesion_results += [[base_name, label if isinstance(label, str) else float(label)] + row for row in lesion_rows]
+    return results, lesion_results
+
+def case_rows(base_name, ground_truth, prediction, zooms, lesion_labels=(), min_lesion_volume_mm3=0.0, timer=NULL_TIMER):
+    # (rows, lesion rows) of one case from its GT and predicted label arrays; shared with run_pipeline.py
+    with timer.stage('histogram'):
+        labels, confusion = joint_label_histogram(ground_truth, prediction)
+    region_masks = array_region_masks(ground_truth, prediction)
+    metrics_per_segmentation = metrics_from_confusion(labels, confusion, ground_truth.size, zooms, region_masks, timer)
+    return rows_from_metrics(base_name, metrics_per_segmentation, region_masks, zooms, lesion_labels, min_lesion_volume_mm3, timer)
+
+def process_file(gt_file, ground_truth_dir, inference_dir, label_store_dir=None, instrument=False, lesion_labels=(), min_lesion_volume_mm3=0.0):
+    # With label_store_dir set, both volumes are read through (lazily built) label stores instead of the NIfTI files.
+    # instrument=True adds a per-stage timing record for the run report under 'report'.
+    # lesion_labels adds per-lesion rows for those labels under 'lesion_rows' (components under min_lesion_volume_mm3 are ignored).
     base_name = os.path.splitext(gt_file)[0]
     gt_path = os.path.join(ground_truth_dir, gt_file)
     pred_path = os.path.join(inference_dir, gt_file)
+    timer = CaseTimer(base_name, enabled=instrument)
+    results = []
+    lesion_results = []
+    status = 'missing prediction'
     
     if os.path.exists(pred_path):
         try:
             print(f"Processing file: {gt_path}")  # Print statement to identify the file
-            gt_data = nib.load(gt_path).get_fdata()
-            pred_data = nib.load(pred_path).get_fdata()
-            
-            metrics_per_segmentation = calculate_metrics_per_segmentation(gt_data, pred_data, gt_path)
-            
-            results = []
-            for label, metrics in metrics_per_segmentation.items():
-                results.append([base_name, label] + list(metrics))
-            return results
+            timer.read_file(gt_path)
+            timer.read_file(pred_path)
+            if label_store_dir is not None:
+                with timer.stage('load'):
+                    gt_store = open_label_store(gt_path, label_store_dir)
+                    pred_store = open_label_store(pred_path, label_store_dir)
+                metrics_per_segmentation = calculate_metrics_per_segmentation_from_stores(gt_store, pred_store, timer)
+                results, lesion_results = rows_from_metrics(base_name, metrics_per_segmentation, store_region_masks(gt_store, pred_store), gt_store.zooms,
+                                                            lesion_labels, min_lesion_volume_mm3, timer)
+            else:
+                # Label maps are read in their stored dtype and the GT header is reused for zooms.
+                # The arrays are memory-mapped or decompressed here, so 'load' includes gzip and decoding.
+                with timer.stage('load'):
+                    gt_data, gt_header = load_volume(gt_path)
+                    pred_data, _ = load_volume(pred_path)
+                results, lesion_results = case_rows(base_name, gt_data, pred_data, gt_header.get_zooms(), lesion_labels, min_lesion_volume_mm3, timer)
+            status = 'ok'
         except Exception as e:
             print(f"Error processing file {gt_path}: {e}")
-    return []
+            results = []
+            lesion_results = []
+            status = 'error'
+    timer.set(labels=len(results), lesions=len(lesion_results))
+    return {'rows': results, 'lesion_rows': lesion_results, 'peak_rss_mb': peak_rss_mb(), 'report': timer.finish(status)}
 
-def main(ground_truth_dir, inference_dir, output_csv):
-    ground_truth_files = [f for f in os.listdir(ground_truth_dir) if f.endswith('.nii.gz')]
-    total_files = len(ground_truth_files)
-    
-    with open(output_csv, mode='w', newline='') as file:
+CSV_HEADER = ['Case', 'Segmentation Label', 'IoU (Jaccard Index)', 'Dice', 'Pixel Accuracy', 'Precision', 'Recall', 'F1 Score', 'Mean Absolute Error', 'Hausdorff Distance (mm)', 'HD95 (mm)', 'ASSD (mm)', 'Ground Truth Voxel Count', 'Inference Voxel Count', 'GT Voxel Size (cm^3)', 'Ground Truth Segment Volume (cm^3)', 'Inference Segment Volume (cm^3)']
+
+# Bump whenever a metric definition or the CSV columns change, so cached rows from older code are not reused
+METRICS_VERSION = 3
+# Same for the lesion-wise rows
+LESION_METRICS_VERSION = 1
+
+def submit_bounded(executor, fn, arg_tuples, max_in_flight):
+    # Yields (args, future) as tasks finish, never keeping more than max_in_flight tasks submitted at once
+    arg_tuples = iter(arg_tuples)
+    pending = {}
+    while True:
+        for args in arg_tuples:
+            pending[executor.submit(fn, *args)] = args
+            if len(pending) >= max_in_flight:
+                break
+        if not pending:
+            return
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield pending.pop(future), future
+
+def format_eta(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:d}:{minutes:02d}:{seconds:02d}"
+
+def reorder_csv(output_csv, case_order):
+    # Rewrite the CSV with cases in input order (rows of one case keep their relative order)
+    with open(output_csv, newline='') as file:
+        reader = csv.reader(file)
+        header = next(reader)
+        rows = sorted(reader, key=lambda row: case_order.get(row[0], len(case_order)))
+    tmp_csv = output_csv + '.tmp'
+    with open(tmp_csv, mode='w', newline='') as file:
         writer = csv.writer(file)
-        writer.writerow(['Case', 'Segmentation Label', 'IoU (Jaccard Index)', 'Dice', 'Pixel Accuracy', 'Precision', 'Recall', 'F1 Score', 'Mean Absolute Error', 'Hausdorff Distance', 'Ground Truth Voxel Count', 'Inference Voxel Count', 'GT Voxel Size (cm^3)', 'Ground Truth Segment Volume (cm^3)', 'Inference Segment Volume (cm^3)'])
+        writer.writerow(header)
+        writer.writerows(rows)
+    os.replace(tmp_csv, output_csv)
+
+def main(ground_truth_dir, inference_dir, output_csv, cache_dir=None, force=False, content_hash=False, max_workers=None, max_in_flight=None, reorder=True, label_store_dir=None,
+         report_jsonl=None, report_prometheus=None, lesion_csv=lesion_csv, lesion_labels=lesion_labels, min_lesion_volume_mm3=min_lesion_volume_mm3):
+    # Per-case rows are cached on disk (default: next to output_csv) keyed on the GT and prediction files.
+    # force=True recomputes every case and overwrites its cache entry; content_hash=True fingerprints whole files.
+    # Rows are written as cases finish, with at most max_in_flight cases (default 2 per worker) queued in the pool;
+    # reorder=True sorts the finished CSV back into input order.
+    # label_store_dir reads the volumes through the chunked label store cache kept in that directory.
+    # report_jsonl / report_prometheus write per-case stage timings and run totals (see instrumentation.py).
+    # lesion_csv also writes lesion-wise detection metrics for lesion_labels (see lesion_metrics.py), one row per lesion.
+    # Returns the number of cases, the number computed (not cached) and the peak RSS of the pool workers.
+    with RunReport('segmentation_stats', report_jsonl, report_prometheus) as report:
+        ground_truth_files = [f for f in os.listdir(ground_truth_dir) if f.endswith('.nii.gz')]
+        total_files = len(ground_truth_files)
+        max_workers = max_workers or os.cpu_count()
+        max_in_flight = max_in_flight or 2 * max_workers
+        if cache_dir is None:
+            cache_dir = os.path.splitext(output_csv)[0] + '_cache'
+    
+        # Look up every case with a prediction; only cache misses go to the worker pool
+        lesion_labels = tuple(lesion_labels) if lesion_csv else ()
+        lesion_version = f"{METRICS_VERSION}:lesions:{LESION_METRICS_VERSION}:{lesion_labels}:{min_lesion_volume_mm3}"
+        cache_keys = {}
+        lesion_cache_keys = {}
+        cached_rows = {}
+        cached_lesion_rows = {}
+        with report.stage('cache_lookup'):
+            for gt_file in ground_truth_files:
+                gt_path = os.path.join(ground_truth_dir, gt_file)
+                pred_path = os.path.join(inference_dir, gt_file)
+                if not os.path.exists(pred_path):
+                    continue
+                cache_keys[gt_file] = case_cache_key(gt_file, [gt_path, pred_path], METRICS_VERSION, content_hash)
+                if lesion_labels:
+                    lesion_cache_keys[gt_file] = case_cache_key(gt_file, [gt_path, pred_path], lesion_version, content_hash)
+                if not force:
+                    rows = load_cached_rows(cache_dir, cache_keys[gt_file])
+                    lesion_rows = load_cached_rows(cache_dir, lesion_cache_keys[gt_file]) if lesion_labels else []
+                    # A case is only taken from the cache when every requested output is there
+                    if rows is not None and lesion_rows is not None:
+                        cached_rows[gt_file] = rows
+                        cached_lesion_rows[gt_file] = lesion_rows
+                        report.record(report.case(os.path.splitext(gt_file)[0]).finish('cached'))
+        print(f"{len(cached_rows)}/{total_files} files found in cache {cache_dir}")
+        to_compute = [gt_file for gt_file in ground_truth_files if gt_file not in cached_rows]
+    
+        with open(output_csv, mode='w', newline='') as file, open(lesion_csv or os.devnull, mode='w', newline='') as lesion_file:
+            writer = csv.writer(file)
+            writer.writerow(CSV_HEADER)
+            lesion_writer = csv.writer(lesion_file)
+            lesion_writer.writerow(LESION_CSV_HEADER)
+            for gt_file in ground_truth_files:
+                if gt_file in cached_rows:
+                    writer.writerows(cached_rows[gt_file])
+                    lesion_writer.writerows(cached_lesion_rows[gt_file])
+            processed = len(cached_rows)
         
-        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
-            futures = [executor.submit(process_file, gt_file, ground_truth_dir, inference_dir) for gt_file in ground_truth_files]
-            for i, future in enumerate(futures):
-                results = future.result()
-                for result in results:
-                    writer.writerow(result)
-                print(f"Processed {i + 1}/{total_files} files")
+            worker_peak_rss = []
+            start = time.perf_counter()
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                tasks = ((gt_file, ground_truth_dir, inference_dir, label_store_dir, report.enabled, lesion_labels, min_lesion_volume_mm3) for gt_file in to_compute)
+                for (gt_file, *_), future in submit_bounded(executor, process_file, tasks, max_in_flight):
+                    outcome = future.result()
+                    with report.stage('write'):
+                        writer.writerows(outcome['rows'])
+                        file.flush()
+                        lesion_writer.writerows(outcome['lesion_rows'])
+                        lesion_file.flush()
+                        # Failed cases return no rows and are not cached, so they are retried on the next run
+                        if outcome['rows'] and gt_file in cache_keys:
+                            store_cached_rows(cache_dir, cache_keys[gt_file], outcome['rows'])
+                            if lesion_labels:
+                                store_cached_rows(cache_dir, lesion_cache_keys[gt_file], outcome['lesion_rows'])
+                    report.record(outcome['report'])
+                    if outcome['peak_rss_mb'] is not None:
+                        worker_peak_rss.append(outcome['peak_rss_mb'])
+                
+                    # Progress and ETA from the measured throughput of the computed cases
+                    processed += 1
+                    computed = processed - len(cached_rows)
+                    rate = computed / (time.perf_counter() - start)
+                    eta = format_eta((total_files - processed) / rate)
+                    print(f"Processed {processed}/{total_files} files ({gt_file}, {rate:.2f} files/s, ETA {eta})")
+    
+        if reorder:
+            with report.stage('write'):
+                case_order = {os.path.splitext(gt_file)[0]: i for i, gt_file in enumerate(ground_truth_files)}
+                reorder_csv(output_csv, case_order)
+                if lesion_csv:
+                    reorder_csv(lesion_csv, case_order)
+        if worker_peak_rss:
+            print(f"Peak worker RSS: {max(worker_peak_rss):.0f} MB")
+    return {'cases': total_files, 'computed': len(to_compute), 'worker_peak_rss_mb': max(worker_peak_rss, default=None)}
 
 if __name__ == "__main__":
-    main('', '/Users/jamesdowney/Documents/Project_Data/Cleaned_and_Labelled/TSS/Generated Segmentations/batch/completed/extras/flat_anatomy_batch_output_delete_and_remap_with_extras', '/Users/jamesdowney/Library/CloudStorage/OneDrive-Personal/UNI/UNSW/Phase 2/Honours/Stats/rerun_path/anatomy_flat.csv')
+    main('', '/Users/jamesdowney/Documents/Project_Data/Cleaned_and_Labelled/TSS/Generated Segmentations/batch/completed/extras/flat_anatomy_batch_output_delete_and_remap_with_extras', '/Users/jamesdowney/Library/CloudStorage/OneDrive-Personal/UNI/UNSW/Phase 2/Honours/Stats/rerun_path/anatomy_flat.csv',
+         lesion_csv=lesion_csv, lesion_labels=lesion_labels, min_lesion_volume_mm3=min_lesion_volume_mm3)
 
 
 ###main: 'GT dir', 'inference dir', 'output.csv')
\ No newline at end of file
@@ -0,0 +1,69 @@
+import numpy as np
+from scipy import ndimage
+
+# Surface distance metrics between two binary masks, in the physical units of the voxel spacing (mm for NIfTI).
+# Only boundary voxels take part, and all work is done inside the joint bounding box of both masks.
+#
+# Empty masks:
+#   both masks empty    -> all distances are 0.0
+#   one mask empty      -> all distances are nan (there is no surface to measure against)
+
+
+def joint_bounding_box(ground_truth, prediction, margin=1):
+    # Slices covering the foreground of both masks, padded by `margin` voxels where the volume allows
+    coords = np.nonzero(np.logical_or(ground_truth, prediction))
+    if len(coords[0]) == 0:
+        return None
+    return tuple(
+        slice(max(int(c.min()) - margin, 0), min(int(c.max()) + 1 + margin, size))
+        for c, size in zip(coords, ground_truth.shape)
+    )
+
+
+def extract_surface(mask, connectivity=1):
+    # Foreground voxels with at least one background neighbour (voxels outside the array count as background)
+    mask = np.asarray(mask, dtype=bool)
+    structure = ndimage.generate_binary_structure(mask.ndim, connectivity)
+    eroded = ndimage.binary_erosion(mask, structure=structure, border_value=0)
+    return mask & ~eroded
+
+
+def surface_distance_samples(ground_truth, prediction, spacing=None, connectivity=1):
+    # Distances from every GT surface voxel to the predicted surface, and from every predicted surface voxel to the GT surface
+    ground_truth = np.asarray(ground_truth, dtype=bool)
+    prediction = np.asarray(prediction, dtype=bool)
+    if ground_truth.shape != prediction.shape:
+        raise ValueError(f"Mask shapes differ: {ground_truth.shape} vs {prediction.shape}")
+    if spacing is None:
+        spacing = (1.0,) * ground_truth.ndim
+    spacing = tuple(float(s) for s in spacing[:ground_truth.ndim])
+
+    bbox = joint_bounding_box(ground_truth, prediction)
+    if bbox is None:
+        return np.zeros(0), np.zeros(0)
+    gt_surface = extract_surface(ground_truth[bbox], connectivity)
+    pred_surface = extract_surface(prediction[bbox], connectivity)
+    if not gt_surface.any() or not pred_surface.any():
+        return None, None
+
+    # Each EDT gives, for every voxel in the box, the distance to the nearest surface voxel of the other mask
+    dist_to_pred = ndimage.distance_transform_edt(~pred_surface, sampling=spacing)
+    dist_to_gt = ndimage.distance_transform_edt(~gt_surface, sampling=spacing)
+    return dist_to_pred[gt_surface], dist_to_gt[pred_surface]
+
+
+def calculate_surface_distances(ground_truth, prediction, spacing=None, percentile=95, connectivity=1):
+    # Returns (Hausdorff distance, percentile Hausdorff distance, average symmetric surface distance).
+    # Like the Hausdorff distance, the percentile distance is symmetric: the larger of the GT -> prediction and
+    # prediction -> GT percentiles, each taken over its own direction's distances (the usual HD95 definition).
+    gt_to_pred, pred_to_gt = surface_distance_samples(ground_truth, prediction, spacing, connectivity)
+    if gt_to_pred is None:
+        return np.nan, np.nan, np.nan
+    if gt_to_pred.size == 0:
+        return 0.0, 0.0, 0.0
+
+    all_distances = np.concatenate([gt_to_pred, pred_to_gt])
+    hausdorff = float(max(gt_to_pred.max(), pred_to_gt.max()))
+    hausdorff_percentile = float(max(np.percentile(gt_to_pred, percentile), np.percentile(pred_to_gt, percentile)))
+    assd = float(all_distances.mean())
+    return hausdorff, hausdorff_percentile, assd
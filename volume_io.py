@@ -0,0 +1,49 @@
+import sys
+from contextlib import contextmanager
+import numpy as np
+import nibabel as nib
+from nibabel.openers import ImageOpener
+
+try:
+    import resource
+except ImportError:  # Windows has no resource module
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Shared volume loading for the stats and conversion scripts.
+# Label maps are read in the dtype they are stored in (uint8/int16 instead of get_fdata()'s float64),
+# and uncompressed .nii files are memory-mapped rather than read into memory.
+
+
+def load_volume(path, mmap=True):
+    # Returns (data, header). The header is read once and returned so callers never reload the file for zooms etc.
+    # Data is only converted to float when the header sets scl_slope/scl_inter, exactly as get_fdata() would scale it.
+    img = nib.load(path, mmap='r' if mmap else False)
+    data = np.asanyarray(img.dataobj)
+    return data, img.header
+
+
+@contextmanager
+def open_image(path):
+    # Yields a lazily loaded NIfTI image whose dataobj reads through one file handle owned by this context.
+    # Slicing dataobj reads only the requested region (forward through the stream for .nii.gz), and the
+    # handle is closed on exit, so the file can then be replaced even on Windows.
+    with ImageOpener(path) as fileobj:
+        holder = nib.FileHolder(fileobj=fileobj)
+        yield nib.Nifti1Image.from_file_map({'header': holder, 'image': holder}, mmap=False)
+
+
+def peak_rss_mb():
+    # Peak resident set size of the current process in MB, or None when the platform cannot report it
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and kilobytes on Linux
+        return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+    if psutil is not None:
+        memory = psutil.Process().memory_info()
+        return getattr(memory, 'peak_wset', memory.rss) / (1024 * 1024)
+    return None